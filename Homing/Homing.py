@@ -3,7 +3,6 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import time
 
 #
 # Homing
@@ -18,7 +17,8 @@ class Homing(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "Homing" # TODO make this more human readable by adding spaces
     self.parent.categories = ["Examples"]
-    self.parent.dependencies = []
+    # shares the OpenIGTLink connection of PathPlannerLib
+    self.parent.dependencies = ["PathPlanner"]
     self.parent.contributors = ["John Doe (AnyWare Corp.)"] # replace with "Firstname Lastname (Organization)"
     self.parent.helpText = """
 This is an example of scripted loadable module bundled in an extension.
@@ -215,50 +215,28 @@ class HomingLogic(ScriptedLoadableModuleLogic):
   """
 
   def checkConnection(self):
-    if slicer.util.getNodesByClass('vtkMRMLIGTLConnectorNode'):
-      self.cnode = slicer.util.getNode('OIGTL*')
+    # imported here, once PathPlanner has put PathPlannerLib on the path
+    from PathPlannerLib import IGTLMessaging
+    self.connection = IGTLMessaging.ConnectionManager.instance()
+    if self.connection.getConnector() is not None:
       print(' - openIGTLink already open -')
       return True
     else:
       return False
 
 
-  def sendInitUS(self):
-    try:
-      self.initText = slicer.util.getNode('INIT')
-    except:
-      self.initText = slicer.vtkMRMLTextNode()
-      self.initText.SetName("INIT")
-      slicer.mrmlScene.AddNode(self.initText)
-    self.initText.SetText("INITUS")
-    if self.cnode.GetState() == 2:
-      self.cnode.RegisterOutgoingMRMLNode(self.initText)
-      self.cnode.PushNode(self.initText)
-      time.sleep(2)
-      self.cnode.UnregisterOutgoingMRMLNode(self.initText)    
-      return True
-    else:
-      print(' Connection not stablished, check OpenIGTLink -')
-      return False
+  def sendInitUS(self,callback=None):
+    return self.sendInitText("INITUS", 2.0, callback)
 
 
-  def sendInitPM(self,position):
-    try:
-      self.initText = slicer.util.getNode('INIT')
-    except:
-      self.initText = slicer.vtkMRMLTextNode()
-      self.initText.SetName("INIT")
-      slicer.mrmlScene.AddNode(self.initText)
-    self.initText.SetText("INIT"+position)
-    if self.cnode.GetState() == 2:
-      self.cnode.RegisterOutgoingMRMLNode(self.initText)
-      self.cnode.PushNode(self.initText)
-      time.sleep(0.1)
-      self.cnode.UnregisterOutgoingMRMLNode(self.initText)    
-      return True
-    else:
+  def sendInitPM(self,position,callback=None):
+    return self.sendInitText("INIT"+position, 0.1, callback)
+
+  def sendInitText(self,text,holdTime,callback=None):
+    message = self.connection.sendText("INIT", text, holdTime, callback)
+    if not message:
       print(' Connection not stablished, check OpenIGTLink -')
-      return False
+    return message
       
 
 
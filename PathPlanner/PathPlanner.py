@@ -3,12 +3,14 @@ import unittest
 import vtk, qt, ctk, slicer
 #from qt.QtWidgets import QTableWidgetItem
 from slicer.ScriptedLoadableModule import *
+from slicer.util import VTKObservationMixin
 import logging
 import numpy as np
 import sys
 import time
 import logging
-from datetime import datetime
+from PathPlannerLib import AngleSearch, Clearance, IGTLMessaging, LabelMaps, MarkupsArrays, NodeRegistry, PathModel, PlanningCore, ProcedureLogger, UpdateScheduler
+from PathPlannerLib.PlanningCore import DIM1, DIM2, DIM3, DIM4, DIM5, LIMITS, deg2rad
 
 
 AUTOMATIC_PATH = False
@@ -16,18 +18,6 @@ AUTOMATIC_PATH = False
 # PathPlanner
 #
 
-# dimentions from the center of the RCM to the edge of the needle guide:
-DIM1 = 54.5
-DIM2 = 49.5
-DIM3 = 44.5
-DIM4 = 39.5
-DIM5 = 34.5
-
-deg2rad = 3.14/180.0
-
-#translation limits of Smart Template
-LIMITS = [-25,25,-30,30]
-
 class PathPlanner(ScriptedLoadableModule):
   """Uses ScriptedLoadableModule base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
@@ -51,27 +41,28 @@ class PathPlanner(ScriptedLoadableModule):
 # PathPlannerWidget
 #
 
-class PathPlannerWidget(ScriptedLoadableModuleWidget):
+class PathPlannerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   """Uses ScriptedLoadableModuleWidget base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleWidget.__init__(self, parent)
+    VTKObservationMixin.__init__(self)
+    self.targetValues = ["-", "-"]
+    self.deviceState = None
+    # target list and zFrame whose events keep the target table up to date
+    self.targetNode = None
+    self.zFrameNode = None
+
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
     self.logic = PathPlannerLogic()
     # Instantiate and connect widgets ...
 
-    now = datetime.now()
-    dt_string = str(now.strftime("%d/%m/%Y %H:%M:%S"))
-    self.filename = "/home/smart/Documents/test-save.txt"
-    self.logfile = open(self.filename, 'w')
-    self.logfile.write("Log file for Smart Template Clinical Trials \n")
-    self.logfile.write('=========================== \n')
-    self.logfile.write('Today is ' + dt_string +"\n")
-    self.logfile.write('===========================' + "\n")
-
-    self.logfile.write('Path Planner Module reloaded' + "\n")
-    self.logfile.close()
+    # one log file per session, written from a background thread
+    self.procedureLog = ProcedureLogger.ProcedureLogger()
+    self.procedureLog.log("module_reloaded")
     #
     # Parameters Area
     #
@@ -142,8 +133,8 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     #
     self.targetTable = qt.QTableWidget()
     self.targetTable.setRowCount(1)
-    self.targetTable.setColumnCount(4)
-    self.targetTable.setHorizontalHeaderLabels(['Name', 'R', 'A', 'S'])
+    self.targetTable.setColumnCount(5)
+    self.targetTable.setHorizontalHeaderLabels(['Name', 'R', 'A', 'S', 'Reach'])
 
     parametersFormLayout.addRow(self.targetTable)
 
@@ -170,6 +161,23 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     self.updateImage.toolTip = "update image"
     self.updateImage.enabled = True
     parametersFormLayout.addRow(self.updateImage)
+
+    #
+    # surface models of the segmentation, built in the background
+    #
+    parametersFormLayout.addRow("Segmentation: ", self.segmentationSelector)
+
+    self.buildModelsButton = qt.QPushButton("Build surface")
+    self.buildModelsButton.toolTip = "Build the surface models of the segmentation"
+    self.cancelModelsButton = qt.QPushButton("Cancel")
+    self.cancelModelsButton.toolTip = "Stop building the surface models"
+    self.cancelModelsButton.enabled = False
+    parametersFormLayout.addRow(self.buildModelsButton, self.cancelModelsButton)
+
+    self.modelsProgress = qt.QProgressBar()
+    self.modelsProgress.setRange(0, 100)
+    self.modelsProgress.setValue(0)
+    parametersFormLayout.addRow(self.modelsProgress)
     #parametersFormLayout.addRow(self.selectTarget)
 
 #    label = qt.QLabel(self)
@@ -202,6 +210,30 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     self.angleXWidget.setToolTip("needle guide angulation")
     angulationFormLayout.addRow("Coronal", self.angleXWidget)    
     
+    #
+    # Angle search Area
+    #
+    searchCollapsibleButton = ctk.ctkCollapsibleButton()
+    searchCollapsibleButton.text = "Angle search"
+    self.layout.addWidget(searchCollapsibleButton)
+
+    searchFormLayout = qt.QFormLayout(searchCollapsibleButton)
+
+    self.searchAnglesButton = qt.QPushButton("Search angles")
+    self.searchAnglesButton.toolTip = "Score all the needle guide angles for the selected target"
+    self.applyAnglesButton = qt.QPushButton("Apply best")
+    self.applyAnglesButton.toolTip = "Set the sliders to the best angles"
+    self.applyAnglesButton.enabled = False
+    searchFormLayout.addRow(self.searchAnglesButton, self.applyAnglesButton)
+
+    # columns: coronal angle, rows: sagittal angle (up is positive)
+    self.angleHeatmap = qt.QLabel()
+    self.angleHeatmap.setToolTip("Coronal angle (left to right) vs sagittal angle (bottom to top). "
+                                 "Green: better score, gray: out of reach, dark red: collision, white: best")
+    self.angleSearchStatus = qt.QLabel(" -- ")
+    searchFormLayout.addRow(self.angleHeatmap)
+    searchFormLayout.addRow(self.angleSearchStatus)
+
     #
     # replan Area
     #
@@ -228,12 +260,18 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     replanFormLayout.addRow("A-P", self.replanYWidget)
     
     # connections
-    self.angleXWidget.connect('valueChanged(double)', self.onSliderChange)
-    self.angleYWidget.connect('valueChanged(double)', self.onSliderChange)
-    self.replanXWidget.connect('valueChanged(double)', self.onFineTunning)
-    self.replanYWidget.connect('valueChanged(double)', self.onFineTunning)
+    # slider drags are merged into one update per frame
+    self.angleScheduler = UpdateScheduler.UpdateScheduler(self.onSliderChange)
+    self.fineTuningScheduler = UpdateScheduler.UpdateScheduler(self.onFineTunning)
+    self.angleXWidget.connect('valueChanged(double)', self.angleScheduler.schedule)
+    self.angleYWidget.connect('valueChanged(double)', self.angleScheduler.schedule)
+    self.replanXWidget.connect('valueChanged(double)', self.fineTuningScheduler.schedule)
+    self.replanYWidget.connect('valueChanged(double)', self.fineTuningScheduler.schedule)
     self.selectTarget.connect('clicked(bool)', self.onSelectTarget)
+    self.searchAnglesButton.connect('clicked(bool)', self.onSearchAngles)
+    self.applyAnglesButton.connect('clicked(bool)', self.onApplyAngles)
     self.zFrameSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onDefineZFrame)
+    self.segmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.logic.setSegmentation)
     self.zFrameSelector.connect("nodeActivated(vtkMRMLNode*)", self.onDefineZFrame)
     self.targetSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onReloadTarget)
     self.targetSelector.connect("nodeActivated(vtkMRMLNode*)", self.onReloadTarget)
@@ -254,6 +292,10 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     insertionTable5 = qt.QLabel()
     insertionTable5.setText(" pos 5 ")
     insertionTable5.setStyleSheet("background-color: yellow;border: 1px solid black;")
+    # guide position recommended for the current path and the lengths shown
+    self.recommendedGuide = None
+    self.insertionValues = [None]*5
+    self.lastInsertion = None
     self.insertion1 = qt.QLabel()
     self.insertion1.setText(" -- ")
     self.insertion1.setStyleSheet("background-color: white;border: 1px solid black;")
@@ -270,6 +312,8 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     self.insertion5.setText(" -- ")
     self.insertion5.setStyleSheet("background-color: white;border: 1px solid black;")
 
+    self.insertionLabels = [self.insertion1, self.insertion2, self.insertion3, self.insertion4, self.insertion5]
+
     insertionCollapsibleButton = ctk.ctkCollapsibleButton()
     insertionCollapsibleButton.text = "Insertion lengths"
     insertionTable = qt.QGridLayout(insertionCollapsibleButton)
@@ -283,6 +327,24 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     insertionTable.addWidget(self.insertion3,1,3)
     insertionTable.addWidget(self.insertion4,1,4)
     insertionTable.addWidget(self.insertion5,1,5)
+
+    # needles used to recommend a guide position, kept in the application settings
+    settings = qt.QSettings()
+    self.needleLengths = self.parseNeedleLengths(settings.value('PathPlanner/NeedleLengths', ''))
+    self.depthTolerance = float(settings.value('PathPlanner/DepthTolerance', PlanningCore.DEPTH_TOLERANCE))
+    self.needleLengthsEdit = qt.QLineEdit(", ".join("%g" % length for length in self.needleLengths))
+    self.needleLengthsEdit.toolTip = "Lengths [mm] of the needles available for the procedure, separated by commas"
+    self.depthToleranceWidget = qt.QDoubleSpinBox()
+    self.depthToleranceWidget.setRange(0.0, 100.0)
+    self.depthToleranceWidget.suffix = " mm"
+    self.depthToleranceWidget.value = self.depthTolerance
+    self.depthToleranceWidget.toolTip = "How far the tip of a needle inserted up to its hub may pass the target"
+    insertionTable.addWidget(qt.QLabel("Needles:"),2,0)
+    insertionTable.addWidget(self.needleLengthsEdit,2,1,1,2)
+    insertionTable.addWidget(qt.QLabel("Overshoot:"),2,3)
+    insertionTable.addWidget(self.depthToleranceWidget,2,4,1,2)
+    self.needleLengthsEdit.connect('editingFinished()', self.onNeedleSettingsChanged)
+    self.depthToleranceWidget.connect('valueChanged(double)', self.onNeedleSettingsChanged)
     self.layout.addWidget(insertionCollapsibleButton)
 
     #
@@ -428,8 +490,24 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     self.startSegmentation.connect('clicked(bool)', self.onSegmentButton)
     self.abort.connect('clicked(bool)', self.onAbort)
     self.updateImage.connect('clicked(bool)', self.onUpdateImage)
+    self.buildModelsButton.connect('clicked(bool)', self.onBuildModels)
+    self.cancelModelsButton.connect('clicked(bool)', self.logic.cancelModels)
 
-    qt.QTimer.singleShot(2000, self.onTimeout)
+    # fill the target table from the lists selected when the module opens
+    self.onDefineZFrame()
+    self.onReloadTarget()
+    self.logic.setSegmentation(self.segmentationSelector.currentNode())
+
+
+    # device status is updated when OpenIGTLink messages arrive
+    self.statusHandlers = {
+      'state': self.onStateMessage,
+      'status': self.onControllerStatusMessage,
+      'statusTarget': self.onTargetStatusMessage,
+      'motorPosition': self.onMotorPositionMessage,
+      }
+    self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded)
+    self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved)
 
     #
     # Status Area
@@ -477,112 +555,114 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
 
     self.logic.loadzFrameModel()
 
+    for node in slicer.util.getNodesByClass('vtkMRMLIGTLConnectorNode'):
+      self.observeStatusNode(node)
+    for node in slicer.util.getNodesByClass('vtkMRMLTextNode'):
+      self.observeStatusNode(node)
+
     # Add vertical spacer
     self.layout.addStretch(1)
 
     # Refresh Apply button state
 
-  def onTimeout(self):
-    try:
-      self.onReloadTarget()
-      self.igtl = slicer.util.getNode('OIGTL*')
-      if self.igtl.GetState() == 0:
-        self.connectionStatus.setStyleSheet("background-color: pink;border: 1px solid black;")
-        self.connectionStatus.setText("No connection")
-      elif self.igtl.GetState() == 1:
-        self.connectionStatus.setStyleSheet("background-color: yellow;border: 1px solid black;")
-        self.connectionStatus.setText("IGTL - WAIT")
-      elif self.igtl.GetState() == 2:
-        self.connectionStatus.setStyleSheet("background-color: lightgreen;border: 1px solid black;")
-        self.connectionStatus.setText("IGTL - ON")
-        try:
-          tempState = slicer.util.getNode('state')
-          temp = tempState.GetText()
-          if temp == "No":
-            self.deviceStatus.setText('No movement')
-            self.deviceStatus.setStyleSheet("background-color: lightgreen;border: 1px solid black;")
-          if temp == "Press FS":
-            self.deviceStatus.setText(' * Press pedal *')
-            self.deviceStatus.setStyleSheet("background-color: yellow;border: 1px solid black;")
-        except:
-          self.deviceStatus.setText("-")
-        try:
-          #get the motorPosition
-          tempString1 = slicer.util.getNode('motorPosition')
-          temp = tempString1.GetText()
-          motorPositions = temp.split(", ")        
-          self.USLabel1.setText(motorPositions[0])
-          self.USLabel2.setText(motorPositions[1])
-          self.PELabel1.setText(motorPositions[2])
-          self.PELabel2.setText(motorPositions[3])
-        except:
-          self.USLabel1.setText("-")
-          self.USLabel2.setText("-")
-          self.PELabel1.setText("-")
-          self.PELabel2.setText("-")
-        try:
-          tempString1 = slicer.util.getNode('status')
-          temp = tempString1.GetText()
-          self.galilStatus.setText(temp)
-          if temp == "No Galil connection":
-            self.label4.setText(temp)
-            self.label4.setStyleSheet("background-color: pink;white: 1px solid black;")
-            self.galilStatus.setStyleSheet("background-color: pink;border: 1px solid black;")
-          elif temp == "FTSW OFF":
-            self.galilStatus.setStyleSheet("background-color: yellow;border: 1px solid black;")
-          elif temp == "FTSW ON":
-            self.galilStatus.setStyleSheet("background-color: lightgreen;border: 1px solid black;")           
-        except:
-          self.galilStatus.setText("No Controller connection")
-          self.galilStatus.setStyleSheet("background-color: pink;border: 1px solid black;")
-          self.footswitchStatus.setText("Footswitch OFF")
-          self.footswitchStatus.setStyleSheet("background-color: pink;border: 1px solid black;")
-        try:
-          tempStatus2 = slicer.util.getNode('statusTarget')
-          temp = tempStatus2.GetText()
-          self.targetValues = temp.split(" - ")
-          self.targetStatus.setText(self.targetValues[0])
-          self.targetStatus.setStyleSheet("background-color: lightgreen;border: 1px solid black;")  
-          self.angleStatus.setText(self.targetValues[1])
-          self.angleStatus.setStyleSheet("background-color: lightgreen;border: 1px solid black;")  
-        except:
-          self.targetStatus.setText("No Controller connection")
-          self.targetStatus.setStyleSheet("background-color: pink;border: 1px solid black;")
-          self.angleStatus.setText("No Controller connection")
-          self.angleStatus.setStyleSheet("background-color: pink;border: 1px solid black;")
-        try:
-          tempStatus3 = slicer.util.getNode('state')
-
-          if tempStatus3.GetText() == "No":
-            self.label4.setText("Idle - waiting")
-            self.label4.setStyleSheet("background-color: lightblue;border: 1px solid black;")
-          if tempStatus3.GetText() == "Waiting movement":
-            self.label4.setText("Waiting movement - Press pedal!")
-            self.label4.setStyleSheet("background-color: yellow;border: 1px solid black;")
-          if tempStatus3.GetText() == "Movement done":
-            self.label4.setText("Mov. Done!")
-            self.label4.setStyleSheet("background-color: lightgreen;border: 1px solid black;")
-          if tempStatus3.GetText() == "Movement aborted":
-            self.label4.setText("MOVEMENT ABORTED - send another target")
-            self.label4.setStyleSheet("background-color: pink;border: 1px solid black;")
-        except:
-          self.label4.setText("No connection")
-          self.label4.setStyleSheet("background-color: lightblue;border: 1px solid black;")
-
-
-
-
-    except:
-      self.connectionStatus.setText("IGTL - OFF")
-
-
-    qt.QTimer.singleShot(2000, self.onTimeout)
+  def setStatusLabel(self,label,text,color):
+    """Update a status label, touching the widget only if its text or color changed."""
+    style = "background-color: "+color+";border: 1px solid black;"
+    if label.text != text:
+      label.setText(text)
+    if label.styleSheet != style:
+      label.setStyleSheet(style)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self,caller,event,node):
+    self.observeStatusNode(node)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self,caller,event,node):
+    if node.IsA('vtkMRMLIGTLConnectorNode'):
+      for event in [slicer.vtkMRMLIGTLConnectorNode.ConnectedEvent, slicer.vtkMRMLIGTLConnectorNode.DisconnectedEvent,
+                    slicer.vtkMRMLIGTLConnectorNode.ActivatedEvent, slicer.vtkMRMLIGTLConnectorNode.DeactivatedEvent]:
+        self.removeObserver(node, event, self.onConnectorStateChanged)
+      # the removed connector sends no DisconnectedEvent
+      self.setStatusLabel(self.connectionStatus, "No connection", "pink")
+    elif node.IsA('vtkMRMLTextNode'):
+      self.removeObserver(node, vtk.vtkCommand.ModifiedEvent, self.onStatusMessage)
+
+  def observeStatusNode(self,node):
+    if node.IsA('vtkMRMLIGTLConnectorNode'):
+      for event in [slicer.vtkMRMLIGTLConnectorNode.ConnectedEvent, slicer.vtkMRMLIGTLConnectorNode.DisconnectedEvent,
+                    slicer.vtkMRMLIGTLConnectorNode.ActivatedEvent, slicer.vtkMRMLIGTLConnectorNode.DeactivatedEvent]:
+        self.addObserver(node, event, self.onConnectorStateChanged)
+      self.onConnectorStateChanged(node)
+    elif node.IsA('vtkMRMLTextNode'):
+      # incoming nodes may be named after they are added, so dispatch on the current name
+      self.addObserver(node, vtk.vtkCommand.ModifiedEvent, self.onStatusMessage)
+      self.onStatusMessage(node)
+
+  def onConnectorStateChanged(self,connector,event=None):
+    state = connector.GetState()
+    if state == slicer.vtkMRMLIGTLConnectorNode.StateOff:
+      self.setStatusLabel(self.connectionStatus, "No connection", "pink")
+    elif state == slicer.vtkMRMLIGTLConnectorNode.StateWaitConnection:
+      self.setStatusLabel(self.connectionStatus, "IGTL - WAIT", "yellow")
+    elif state == slicer.vtkMRMLIGTLConnectorNode.StateConnected:
+      self.setStatusLabel(self.connectionStatus, "IGTL - ON", "lightgreen")
+
+  def onStatusMessage(self,textNode,event=None):
+    handler = self.statusHandlers.get(textNode.GetName())
+    if handler and textNode.GetText():
+      handler(textNode.GetText())
+
+  def onStateMessage(self,temp):
+    if temp != self.deviceState:
+      self.deviceState = temp
+      self.logEvent("device_state", message=temp)
+    if temp == "No":
+      self.setStatusLabel(self.deviceStatus, 'No movement', "lightgreen")
+      self.setStatusLabel(self.label4, "Idle - waiting", "lightblue")
+    elif temp == "Press FS":
+      self.setStatusLabel(self.deviceStatus, ' * Press pedal *', "yellow")
+    elif temp == "Waiting movement":
+      self.setStatusLabel(self.label4, "Waiting movement - Press pedal!", "yellow")
+    elif temp == "Movement done":
+      self.setStatusLabel(self.label4, "Mov. Done!", "lightgreen")
+    elif temp == "Movement aborted":
+      self.setStatusLabel(self.label4, "MOVEMENT ABORTED - send another target", "pink")
+
+  def onMotorPositionMessage(self,temp):
+    motorPositions = temp.split(", ")
+    if len(motorPositions) < 4:
+      motorPositions = ["-", "-", "-", "-"]
+    self.setStatusLabel(self.USLabel1, motorPositions[0], "white")
+    self.setStatusLabel(self.USLabel2, motorPositions[1], "white")
+    self.setStatusLabel(self.PELabel1, motorPositions[2], "white")
+    self.setStatusLabel(self.PELabel2, motorPositions[3], "white")
+
+  def onControllerStatusMessage(self,temp):
+    if temp == "No Galil connection":
+      self.setStatusLabel(self.label4, temp, "pink")
+      self.setStatusLabel(self.galilStatus, temp, "pink")
+    elif temp == "FTSW OFF":
+      self.setStatusLabel(self.galilStatus, temp, "yellow")
+    elif temp == "FTSW ON":
+      self.setStatusLabel(self.galilStatus, temp, "lightgreen")
+    elif self.galilStatus.text != temp:
+      self.galilStatus.setText(temp)
+
+  def onTargetStatusMessage(self,temp):
+    targetValues = temp.split(" - ")
+    if len(targetValues) < 2:
+      return
+    self.targetValues = targetValues
+    self.setStatusLabel(self.targetStatus, self.targetValues[0], "lightgreen")
+    self.setStatusLabel(self.angleStatus, self.targetValues[1], "lightgreen")
 
-  def saveToLog(self,msg):
-    now = datetime.now()
-    dt_string = str(now.strftime("%d/%m/%Y %H:%M:%S"))
-    with open(self.filename, 'a') as f:
-      f.write(dt_string+msg)
+  def logEvent(self,event,**fields):
+    """Add an event, with the selected target, slider angles and device state, to the procedure log."""
+    state = {'connection': self.connectionStatus.text, 'controller': self.galilStatus.text, 'movement': self.label4.text}
+    target = getattr(self, 'selectedTarget', None)
+    self.procedureLog.log(event, list(target) if target else None,
+                          [self.angleXWidget.value, self.angleYWidget.value], state, **fields)
 
   def getAngles(self,mtx):
     vTransform = vtk.vtkTransform()
@@ -598,15 +678,16 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     slicer.util.setSliceViewerLayers(background=images.GetItemAsObject(nOfImages-1), foreground=images.GetItemAsObject(nOfImages-2))
 
   def onAbort(self):
-    self.logic.sendAbort()
-    self.logfile.write('Movement aborted by the user \n')
+    self.logic.sendAbort(time.perf_counter())
+    self.logEvent("abort")
+    self.procedureLog.flush()
     print("stop motion")
 
   def onzFrameButton(self):
     if self.logic.sendZFrame(self.zFrameSelector.currentNode()):
       self.zFrameStatus.setText("ZFrame sent")
       self.zFrameStatus.setStyleSheet("background-color: lightgreen;border: 1px solid black;")
-      self.saveToLog("sent z-Frame to ROS")
+      self.logEvent("zframe_sent")
     else:
       print('- zFrame NOT sent -\n')
 
@@ -619,23 +700,87 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     #  print('- Initialization code NOT sent -\n')
 
   def onReloadTarget(self):
-    try:
-      targets = self.targetSelector.currentNode()
-      ras_target = [0.0,0.0,0.0]
-      nOfFiducials = targets.GetNumberOfFiducials()
-      self.targetTable.setRowCount(nOfFiducials)
-      for n in range(nOfFiducials):
-          targets.GetNthFiducialPosition(n, ras_target)
-          self.targetTable.setItem(n,1, qt.QTableWidgetItem(('%.1f' % ras_target[0])))
-          self.targetTable.setItem(n,2, qt.QTableWidgetItem(('%.1f' % ras_target[1])))
-          self.targetTable.setItem(n,3, qt.QTableWidgetItem(('%.1f' % ras_target[2])))
-          self.targetTable.setItem(n,0, qt.QTableWidgetItem(targets.GetNthFiducialLabel(n)))
-    except:
+    """Bind the target table to the selected target list and fill it."""
+    targets = self.targetSelector.currentNode()
+    if targets is not self.targetNode:
+      if self.targetNode is not None:
+        self.removeObserver(self.targetNode, slicer.vtkMRMLMarkupsNode.PointAddedEvent, self.onTargetAdded)
+        self.removeObserver(self.targetNode, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onTargetModified)
+        self.removeObserver(self.targetNode, slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self.onTargetRemoved)
+      self.targetNode = targets
+      if targets is not None:
+        self.addObserver(targets, slicer.vtkMRMLMarkupsNode.PointAddedEvent, self.onTargetAdded)
+        self.addObserver(targets, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onTargetModified)
+        self.addObserver(targets, slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self.onTargetRemoved)
+    self.rebuildTargetTable()
+
+  def rebuildTargetTable(self):
+    ras_targets = MarkupsArrays.getPoints(self.targetNode)
+    self.targetTable.setRowCount(len(ras_targets))
+    for n, ras_target in enumerate(ras_targets):
+      self.setTargetRow(n, ras_target)
+    self.updateReachability(ras_targets, range(len(ras_targets)))
+
+  def setTargetRow(self,n,ras_target=None):
+    """Show target n in row n, touching only the cells whose text changed (keeps the selection colors)."""
+    if ras_target is None:
+      ras_target = MarkupsArrays.getPoint(self.targetNode, n)
+    texts = [self.targetNode.GetNthFiducialLabel(n), '%.1f' % ras_target[0], '%.1f' % ras_target[1], '%.1f' % ras_target[2]]
+    for column, text in enumerate(texts):
+      item = self.targetTable.item(n, column)
+      if item is None:
+        self.targetTable.setItem(n, column, qt.QTableWidgetItem(text))
+      elif item.text() != text:
+        item.setText(text)
+    return ras_target
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onTargetAdded(self,caller,event,n):
+    # events batched by StartModify/EndModify come without a point index
+    if n is None or not 0 <= n <= self.targetTable.rowCount:
+      self.rebuildTargetTable()
+      return
+    self.targetTable.insertRow(n)
+    self.updateReachability(np.array([self.setTargetRow(n)]), [n])
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onTargetModified(self,caller,event,n):
+    if n is None or not 0 <= n < self.targetTable.rowCount or self.targetTable.rowCount != caller.GetNumberOfFiducials():
+      self.rebuildTargetTable()
       return
+    self.updateReachability(np.array([self.setTargetRow(n)]), [n])
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onTargetRemoved(self,caller,event,n):
+    if n is not None and 0 <= n < self.targetTable.rowCount:
+      self.targetTable.removeRow(n)
+    if self.targetTable.rowCount != caller.GetNumberOfFiducials():
+      self.rebuildTargetTable()
+
+  def refreshReachability(self,caller=None,event=None):
+    ras_targets = MarkupsArrays.getPoints(self.targetNode)
+    self.updateReachability(ras_targets, range(len(ras_targets)))
+
+  def updateReachability(self,ras_targets,rows):
+    zFrame = self.zFrameSelector.currentNode()
+    status = self.logic.planReachability(ras_targets, zFrame)[0] if zFrame and len(ras_targets) else None
+    for n, row in enumerate(rows):
+      item = self.targetTable.item(row, 4)
+      if item is None:
+        item = qt.QTableWidgetItem()
+        self.targetTable.setItem(row, 4, item)
+      if status is None:
+        item.setText(" -- ")
+      else:
+        item.setText(PlanningCore.STATUS_NAMES[int(status[n])])
+        if status[n] == PlanningCore.FEASIBLE:
+          item.setBackground(qt.QColor(144,238,144))
+        else:
+          item.setBackground(qt.QColor(255,192,203))
 
   def onsendMoveButton(self):
     if self.logic.sendMove():
-      self.saveToLog("sent code to Move the device \n")
+      self.logEvent("move_sent")
       print('- Move code sent -\n')
     else:
       print('- Move code NOT sent -\n')
@@ -643,30 +788,22 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
   def onSendReconnectButton(self):
     if self.logic.sendReconnect():
       print('- Reconnection code sent -\n')
-      self.saveToLog("sent code to reconnect to Galil \n")
+      self.logEvent("reconnect_sent")
     else:
       print('- Reconnection code NOT sent -\n')
 
   def onSendTargetButton(self):
-    try:
-      self.targetTransformation = slicer.util.getNode('targetTransformation')
-    except:
-      self.targetTransformation = slicer.vtkMRMLLinearTransformNode()
-      self.targetTransformation.SetName("targetTransformation")
-      slicer.mrmlScene.AddNode(self.targetTransformation)
-
     self.sendMoveButton.enabled = True
     
-    if self.logic.sendTarget(self.targetTransformation,self.selectedTarget,self.angleXWidget,self.angleYWidget):
-      self.saveToLog(" Sent target location and angle \n")
+    if self.logic.sendTarget(self.selectedTarget,self.angleXWidget,self.angleYWidget):
+      self.logEvent("target_sent")
       print('- Target sent -\n')
     else:
       print('- Target NOT sent -\n')
 
   def onOpenIGTL(self):
     if self.logic.openConnection():
-      self.connectionStatus.setStyleSheet("background-color: lightgreen;border: 1px solid black;")
-      self.connectionStatus.setText("OpenIGTL")
+      self.setStatusLabel(self.connectionStatus, "OpenIGTL", "lightgreen")
       self.zFrameButton.enabled = True
       self.sendTargetButton.enabled = True
       self.sendAngleButton.enabled = True
@@ -675,33 +812,42 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
       self.sendReconnectButton.enabled = True
 
   def cleanup(self):
-    pass
+    self.removeObservers()
+    self.logic.removeObservers()
+    self.logic.nodes.close()
+    self.angleScheduler.cancel()
+    self.fineTuningScheduler.cancel()
+    logging.info('Slider updates: angles %s, fine tuning %s' % (self.angleScheduler.statistics(), self.fineTuningScheduler.statistics()))
+    self.logic.cancelModels()
+    self.procedureLog.close()
 
   def onSliderChange(self):
-    try:
-      path_points = slicer.util.getNode('path')
-    except:
+    path_points = self.logic.nodes.get('path', create=False)
+    if path_points is None:
       print('No path selected yet')
       return
     self.logic.updatePoints(path_points, self.zDistance2Target,self.angleXWidget.value,self.angleYWidget.value,self.zFrameSelector.currentNode())
     self.upDateInsertionLength(self.zDistance2Target,1)
 
   def onFineTunning(self):
-    try:
-      targets = slicer.util.getNode('IntraopTargets')
-      print(targets)
-      #if not targets.GetNthMarkupLabel("target"):
-      #    target_fiducial = slicer.modules.markups.logic().AddFiducial(0, 0, 0)
-      targets.SetNthFiducialLabel(0, "replaned")
-    except:
+    targets = self.logic.nodes.get('IntraopTargets', create=False)
+    if targets is None or targets.GetNumberOfFiducials() == 0:
       print('No Targets')
       return
-    if self.selectedTarget:
+    #if not targets.GetNthMarkupLabel("target"):
+    #    target_fiducial = slicer.modules.markups.logic().AddFiducial(0, 0, 0)
+    if not self.selectedTarget:
+        targets.SetNthFiducialLabel(0, "replaned")
+    else:
         row = self.targetTable.currentItem().row()
         self.currentTarget = [self.selectedTarget[0]-self.replanXWidget.value, self.selectedTarget[1]-self.replanYWidget.value, self.selectedTarget[2]];
-        targets.SetNthFiducialPosition(row, self.currentTarget[0], self.currentTarget[1], self.currentTarget[2])
-        path_points = slicer.util.getNode('path')
-        path_points.SetNthFiducialPosition(0,self.currentTarget[0], self.currentTarget[1], self.currentTarget[2])
+        # relabel and move the target in one modification of the list
+        wasModifying = targets.StartModify()
+        targets.SetNthFiducialLabel(0, "replaned")
+        MarkupsArrays.setPoints(targets, [self.currentTarget], start=row)
+        targets.EndModify(wasModifying)
+        path_points = self.logic.getPathPoints()
+        MarkupsArrays.setPoints(path_points, [self.currentTarget])
         self.logic.updatePoints(path_points, self.zDistance2Target,self.angleXWidget.value,self.angleYWidget.value,self.zFrameSelector.currentNode())
         self.upDateInsertionLength(self.zDistance2Target,1)
   #      path_points = slicer.util.getNode('path')
@@ -726,43 +872,71 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     dlg.setIcon(qt.QMessageBox.Question)
     button = dlg.exec()
     if button == qt.QMessageBox.Yes:
-      self.saveToLog(" The biopsy core number "+str(biopsyNumber)+" was taken from insertion at target location: "+self.targetValues[0]+"\n" )
+      self.logEvent("biopsy", core=biopsyNumber, deviceTarget=self.targetValues[0])
     else:
       print("No")
 
 
   def onDefineZFrame(self):
-    self.logic.positionTemplate(self.zFrameSelector.currentNode())
-    print("Position tamplate limits")
+    zFrame = self.zFrameSelector.currentNode()
+    if zFrame is not None:
+      self.logic.positionTemplate(zFrame)
+      print("Position tamplate limits")
+    # the reachability column follows the zFrame registration
+    if zFrame is not self.zFrameNode:
+      if self.zFrameNode is not None:
+        self.removeObserver(self.zFrameNode, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.refreshReachability)
+      self.zFrameNode = zFrame
+      if zFrame is not None:
+        self.addObserver(zFrame, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.refreshReachability)
+    if self.targetNode is not None:
+      self.refreshReachability()
+
+  def onBuildModels(self):
+    labelMapNode = self.segmentationSelector.currentNode()
+    if labelMapNode is None:
+      slicer.util.errorDisplay("No segmentation selected")
+      return
+    self.modelsProgress.setValue(0)
+    self.cancelModelsButton.enabled = True
+    self.logic.createModels(labelMapNode, self.onModelsProgress)
+
+  def onModelsProgress(self,progress,status,done):
+    self.modelsProgress.setValue(progress)
+    self.modelsProgress.setFormat(status + " %p%")
+    if done:
+      self.cancelModelsButton.enabled = False
 
   def onSegmentButton(self):
-    try:
-      targetList = slicer.util.getNode('IntraopTargets')
-    except:
-      targetList = slicer.vtkMRMLMarkupsFiducialNode()
-      targetList.SetName("IntraopTargets")
-      slicer.mrmlScene.AddNode(targetList)
+    targetList = self.logic.nodes.get('IntraopTargets')
     slicer.modules.markups.logic().StartPlaceMode(targetList)
     
   
   def onSelectTarget(self):
-    slicer.util.getNode("vtkMRMLSliceNodeRed").SetOrientation("Axial")
-    slicer.util.getNode("vtkMRMLSliceNodeGreen").SetOrientation("Sagittal")
-    slicer.util.getNode("vtkMRMLSliceNodeYellow").SetOrientation("Coronal")
+    self.logic.nodes.get('sliceRed').SetOrientation("Axial")
+    self.logic.nodes.get('sliceGreen').SetOrientation("Sagittal")
+    self.logic.nodes.get('sliceYellow').SetOrientation("Coronal")
     try:
-        self.selectedTarget = [0.0,0.0,0.0];
         row = self.targetTable.currentItem().row()
         targets = self.targetSelector.currentNode()
-        targets.GetNthFiducialPosition(row, self.selectedTarget)
-        self.angleXWidget.value = 0.0
-        self.angleYWidget.value = 0.0
+        self.selectedTarget = list(MarkupsArrays.getPoint(targets, row))
         nOfRows = self.targetTable.rowCount
         if not AUTOMATIC_PATH:
             self.zDistance2Target = self.logic.pathStraight(self.selectedTarget,self.zFrameSelector.currentNode())
-            self.upDateInsertionLength(self.zDistance2Target,0) #type 0 is straight insertion
+            # restore the angles the target was left at (0 for a new target)
+            angles = self.logic.planState['angles']
+            self.angleXWidget.value = angles[0]
+            self.angleYWidget.value = angles[1]
+            self.angleScheduler.cancel()
+            if angles == (0.0, 0.0):
+                self.upDateInsertionLength(self.zDistance2Target,0) #type 0 is straight insertion
+            else:
+                self.onSliderChange()
         else:
             self.zDistance2Target = self.logic.path(self.angleXWidget, self.angleYWidget,self.selectedTarget,self.segmentationSelector.currentNode(),self.zFrameSelector.currentNode())
             self.upDateInsertionLength(self.zDistance2Target, 1) #type 1 is angulated
+        # the plan is already drawn, drop the update queued by setting the sliders
+        self.angleScheduler.cancel()
         for r in range(nOfRows):
             self.targetTable.item(r,1).setForeground(qt.QColor(1,1,1))
             self.targetTable.item(r,2).setForeground(qt.QColor(1,1,1))
@@ -780,9 +954,9 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
         
         # Print current slice offset position
         print(self.selectedTarget)
-        slicer.util.getNode("vtkMRMLSliceNodeRed").SetOrientation("Axial")
-        slicer.util.getNode("vtkMRMLSliceNodeGreen").SetOrientation("Sagittal")
-        slicer.util.getNode("vtkMRMLSliceNodeYellow").SetOrientation("Coronal")
+        self.logic.nodes.get('sliceRed').SetOrientation("Axial")
+        self.logic.nodes.get('sliceGreen').SetOrientation("Sagittal")
+        self.logic.nodes.get('sliceYellow').SetOrientation("Coronal")
         print("repositioning views")
         self.redLogic.SetSliceOffset(self.selectedTarget[2])
         self.greenLogic.SetSliceOffset(self.selectedTarget[0])
@@ -791,212 +965,245 @@ class PathPlannerWidget(ScriptedLoadableModuleWidget):
     except:
         slicer.util.errorDisplay("No target selected")
 
+  def onSearchAngles(self):
+    if not getattr(self, 'selectedTarget', None):
+      slicer.util.errorDisplay("No target selected")
+      return
+    if self.zFrameSelector.currentNode() is None:
+      slicer.util.errorDisplay("No zFrame selected")
+      return
+    result = self.logic.searchAngles(self.selectedTarget, self.zFrameSelector.currentNode(), self.segmentationSelector.currentNode())
+    self.angleSearch = result
+    self.showAngleHeatmap(result)
+    best = result.best()
+    if best is None:
+      self.angleSearchStatus.setText("No reachable angles without collision")
+    else:
+      index = result.bestIndex()
+      text = "Best: coronal %.0f, sagittal %.0f, length %.1f mm" % (best[0], best[1], result.length[index])
+      guide = result.guidePosition(self.needleLengths, self.depthTolerance)
+      if guide is not None:
+        text += "\nSmallest angulation with a guide position: coronal %.0f, sagittal %.0f, pos %d, %d mm needle" % (
+          guide[0], guide[1], guide[2]+1, self.needleLengths[guide[3]])
+      self.angleSearchStatus.setText(text)
+    self.applyAnglesButton.enabled = best is not None
+
+  def showAngleHeatmap(self,result):
+    colors = AngleSearch.heatmapColors(result)
+    rows, columns = colors.shape
+    image = qt.QImage(columns, rows, qt.QImage.Format_RGB32)
+    for r in range(rows):
+      for c in range(columns):
+        image.setPixel(c, rows-1-r, int(colors[r,c]))
+    self.angleHeatmap.setPixmap(qt.QPixmap.fromImage(image).scaled(5*columns, 5*rows))
+
+  def onApplyAngles(self):
+    best = self.angleSearch.best()
+    self.angleXWidget.value = best[0]
+    self.angleYWidget.value = best[1]
+
   def upDateInsertionLength(self,ins,type):
-    if type == 0 and ins > 0:
-      self.insertion1.setText(str(int(ins + DIM1)) + "mm")
-      self.insertion2.setText(str(int(ins + DIM2)) + "mm")
-      self.insertion3.setText(str(int(ins + DIM3)) + "mm")
-      self.insertion4.setText(str(int(ins + DIM4)) + "mm")
-      self.insertion5.setText(str(int(ins + DIM5)) + "mm")
-    elif type == 1 and ins > 0:
-      alpha = deg2rad*self.angleXWidget.value
-      beta = deg2rad*self.angleYWidget.value
-      ins = ins/np.cos(alpha)
-      ins = ins/np.cos(beta)
-      print(ins)
-      self.insertion1.setText(str(int(ins + DIM1)) + "mm")
-      self.insertion2.setText(str(int(ins + DIM2)) + "mm")
-      self.insertion3.setText(str(int(ins + DIM3)) + "mm")
-      self.insertion4.setText(str(int(ins + DIM4)) + "mm")
-      self.insertion5.setText(str(int(ins + DIM5)) + "mm")
+    """Show the insertion lengths of the five guide positions and highlight the recommended one.
+
+    type 0 is a straight insertion, type 1 uses the slider angles. Labels are
+    only touched when their value or the recommendation changes.
+    """
+    if ins <= 0:
+      return
+    self.lastInsertion = (ins, type)
+    if type == 0:
+      angleX, angleY = 0.0, 0.0
+    else:
+      angleX, angleY = self.angleXWidget.value, self.angleYWidget.value
+    lengths = PlanningCore.insertionLengths(ins, angleX, angleY).astype(int)
+    for n, label in enumerate(self.insertionLabels):
+      if lengths[n] != self.insertionValues[n]:
+        self.insertionValues[n] = lengths[n]
+        label.setText("%dmm" % lengths[n])
+
+    choice = PlanningCore.selectGuidePosition(ins, angleX, angleY, self.needleLengths, self.depthTolerance)
+    position = choice[1] if choice else None
+    self.logic.savePlanState((angleX, angleY), (position, float(self.needleLengths[choice[2]])) if choice else None)
+    if position != self.recommendedGuide:
+      self.recommendedGuide = position
+      for n, label in enumerate(self.insertionLabels):
+        if n == position:
+          label.setStyleSheet("background-color: lightgreen;border: 2px solid black;")
+          label.setToolTip("Recommended with the %d mm needle" % self.needleLengths[choice[2]])
+        else:
+          label.setStyleSheet("background-color: white;border: 1px solid black;")
+          label.setToolTip("")
+
+  @staticmethod
+  def parseNeedleLengths(text):
+    """Return the needle lengths in a comma separated text, or the PlanningCore defaults."""
+    try:
+      lengths = np.array([float(value) for value in str(text).split(',') if value.strip()])
+    except ValueError:
+      lengths = np.array([])
+    return lengths if len(lengths) and np.all(lengths > 0) else PlanningCore.NEEDLE_LENGTHS
+
+  def onNeedleSettingsChanged(self):
+    self.needleLengths = self.parseNeedleLengths(self.needleLengthsEdit.text)
+    self.depthTolerance = self.depthToleranceWidget.value
+    self.needleLengthsEdit.text = ", ".join("%g" % length for length in self.needleLengths)
+    settings = qt.QSettings()
+    settings.setValue('PathPlanner/NeedleLengths', self.needleLengthsEdit.text)
+    settings.setValue('PathPlanner/DepthTolerance', self.depthTolerance)
+    # recommend again for the path shown
+    self.recommendedGuide = -1
+    if self.lastInsertion:
+      self.upDateInsertionLength(*self.lastInsertion)
 
 #
 # PathPlannerLogic
 #
-class PathPlannerLogic(ScriptedLoadableModuleLogic):
-
+class PathPlannerLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
+
+  # parsed Resources/templateLimits.vtk, shared by all logic instances
+  templateLimitsPolyData = None
+
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    VTKObservationMixin.__init__(self)
+    # template pose of the zFrame node, rebuilt only when the node is modified
+    self.templateFrame = None
+    self.templateFrameNode = None
+    self.zFrameVersion = 0
+    # plans of recently selected targets, with the slider angles and guide recommendation
+    # the operator left them at; planState is the entry of the plan shown
+    self.planCache = PlanningCore.PlanCache()
+    self.planState = None
+    self.segmentationNode = None
+    # distance field of the segmentation obstacles and the labelmap state it was built from
+    self.clearanceMap = None
+    self.clearanceKey = None
+    self.clearance = None
+    # label centroids per labelmap node ID, with the labelmap state they were computed from
+    self.centroidCache = {}
+    # background model maker job, the hierarchy it fills and the last finished one
+    self.modelMakerNode = None
+    self.modelMakerCallback = None
+    self.pendingModelHierarchy = None
+    self.modelHierarchyNode = None
+    self.connection = IGTLMessaging.ConnectionManager.instance()
+    self.pathModel = PathModel.PathModel()
+    self.zFrameModelNode = None
+    self.templateTransformNode = None
+
+    # named scene nodes, looked up or created once
+    self.nodes = NodeRegistry.NodeRegistry()
+    self.nodes.register('path', NodeRegistry.byName('path', 'vtkMRMLMarkupsFiducialNode'), self.createPathPoints)
+    self.nodes.register('IntraopTargets', NodeRegistry.byName('IntraopTargets', 'vtkMRMLMarkupsFiducialNode'),
+                        lambda: slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'IntraopTargets'))
+    self.nodes.register('TemplateTransform', NodeRegistry.byName('TemplateTransform', 'vtkMRMLTransformNode'),
+                        lambda: slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode', 'TemplateTransform'))
+    self.nodes.register('templateLimits', NodeRegistry.byName('templateLimits', 'vtkMRMLModelNode'), self.createTemplateLimitsModel)
+    self.nodes.register('prostate', NodeRegistry.byPattern('*PROSTATE*'))
+    for color in ['Red', 'Green', 'Yellow']:
+      self.nodes.register('slice'+color, NodeRegistry.byID('vtkMRMLSliceNode'+color))
+
+  def planReachability(self,targets,zFrameTransform):
+    """Return (status, entry, angles) of straight insertions for (N,3) RAS targets, planned in one pass."""
+    plans = self.getTemplateFrame(zFrameTransform).planTargets(targets)
+    return plans.status, plans.entry, plans.angles
 
   def positionTemplate(self,zFrame):
+    """Place the template limits model on the zFrame, updating one persistent transform node."""
+    mtx = slicer.util.vtkMatrixFromArray(self.getTemplateFrame(zFrame).matrix)
 
+    self.zFrameModelNode = self.nodes.get('templateLimits')
+    self.templateTransformNode = self.nodes.get('TemplateTransform')
+    self.templateTransformNode.SetMatrixTransformToParent(mtx)
 
-    vTransform_t = vtk.vtkTransform()
-    vTransform_t.Translate(0,107.0,-114)
-    vTransform_r = vtk.vtkTransform()
-    vTransform_r.RotateX(-90)
-    vT_temp = vtk.vtkTransform()
-    vT_temp2 = vtk.vtkTransform()
-
-    #vtk.vtkMatrix4x4.Multiply4x4(zFrame.GetMatrixTransformFromParent(),vTransform_r.GetMatrix(),vT_temp.GetMatrix())
-    
-    #vtk.vtkMatrix4x4.Multiply4x4(vTransform_r.GetMatrix(),vTransform_t.GetMatrix(),vT_temp.GetMatrix())
-    vtk.vtkMatrix4x4.Multiply4x4(vTransform_t.GetMatrix(),vTransform_r.GetMatrix(),vT_temp.GetMatrix())
-    vtk.vtkMatrix4x4.Multiply4x4(vT_temp.GetMatrix(),zFrame.GetMatrixTransformFromParent(),vT_temp2.GetMatrix())
-
-    print(zFrame.GetMatrixTransformToParent())
-    print(vT_temp.GetMatrix())
-    print(vT_temp2.GetMatrix())
-
-    mtx = vtk.vtkMatrix4x4()
-    mtx_input = vtk.vtkMatrix4x4()
-    zFrame.GetMatrixTransformToWorld(mtx_input)
-    mtx = self.transformZframe(mtx_input)
-
-    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode")
-    transformNode.SetAndObserveMatrixTransformToParent(mtx)#vT_temp2.GetMatrix())
-       
-    self.zFrameModelNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    if self.zFrameModelNode.GetTransformNodeID() != self.templateTransformNode.GetID():
+      self.zFrameModelNode.SetAndObserveTransformNodeID(self.templateTransformNode.GetID())
     self.zFrameModelNode.GetDisplayNode().SetVisibility(True)
     self.zFrameModelNode.GetDisplayNode().SetSliceIntersectionVisibility(True)
 
-  def loadzFrameModel(self):
-
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    print(dir_path)
-    _, self.zFrameModelNode = slicer.util.loadModel(dir_path+"/Resources/templateLimits.vtk", returnNode=True)
-    slicer.mrmlScene.AddNode(self.zFrameModelNode)
-    self.zFrameModelNode.GetDisplayNode().SetSliceIntersectionVisibility(False)
-    self.zFrameModelNode.GetDisplayNode().SetSliceIntersectionThickness(3)
-    self.zFrameModelNode.GetDisplayNode().SetColor(1,1,0)
-    self.zFrameModelNode.GetDisplayNode().SetVisibility(False)
+  def getTemplateLimitsPolyData(self):
+    """Return the template limits surface, read from Resources/templateLimits.vtk once per session."""
+    if PathPlannerLogic.templateLimitsPolyData is None:
+      dir_path = os.path.dirname(os.path.realpath(__file__))
+      reader = vtk.vtkPolyDataReader()
+      reader.SetFileName(dir_path+"/Resources/templateLimits.vtk")
+      reader.Update()
+      PathPlannerLogic.templateLimitsPolyData = reader.GetOutput()
+    return PathPlannerLogic.templateLimitsPolyData
 
-    try:
-      destNode = slicer.util.getNode('pathModel')
-    except:
-      destNode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
-      destNode.SetName('pathModel')
-      slicer.mrmlScene.AddNode(destNode)
-    print("LOADED MODEL")
+  def loadzFrameModel(self):
+    """Show the template limits in the 'templateLimits' model node, reusing the node of a previous setup."""
+    self.zFrameModelNode = self.nodes.get('templateLimits')
+    self.pathModel.getNode()
+
+  def createTemplateLimitsModel(self):
+    modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "templateLimits")
+    modelNode.SetAndObservePolyData(self.getTemplateLimitsPolyData())
+    modelNode.CreateDefaultDisplayNodes()
+    modelNode.GetDisplayNode().SetSliceIntersectionVisibility(False)
+    modelNode.GetDisplayNode().SetSliceIntersectionThickness(3)
+    modelNode.GetDisplayNode().SetColor(1,1,0)
+    modelNode.GetDisplayNode().SetVisibility(False)
+    return modelNode
 
   def setzFrameVisibility(self,param):
     self.zFrameModelNode.SetDisplayVisibility(param)    
 
   def updatePoints(self,path_points,distance_to_zFrame,angleX,angleY,zFrameTransform):
-    _point1 = [0.0, 0.0, 0.0]
-    _point2 = [0.0, 0.0, 0.0]
-    _point3 = [0.0, 0.0, 0.0]
-    path_points.GetNthFiducialPosition(0, _point1)
-    path_points.GetNthFiducialPosition(1, _point2)
-    path_points.GetNthFiducialPosition(2, _point3)
-    _angleX = (angleX)*3.14/180
-    _angleY = (angleY)*3.14/180
-
-    _point3[0] = _point1[0] + distance_to_zFrame * np.sin(_angleX)
-    _point3[1] = _point1[1] + distance_to_zFrame * np.sin(_angleY)
-    _point3[2] = _point1[2] - distance_to_zFrame
+    target = MarkupsArrays.getPoint(path_points, 0)
+    center, entry, inside = self.getTemplateFrame(zFrameTransform).angulatedPath(target, distance_to_zFrame, angleX, angleY)
+    MarkupsArrays.setPoints(path_points, [center, entry], start=1)
 
+    self.pathModel.update(entry, target)
+    self.setColorPath(inside)
 
-    _point2[0] = _point1[0] + distance_to_zFrame/2.0 * np.sin(_angleX)
-    _point2[1] = _point1[1] + distance_to_zFrame/2.0 * np.sin(_angleY)
-    _point2[2] = _point1[2] - distance_to_zFrame/2.0
 
-    path_points.SetNthFiducialPosition(1, _point2[0], _point2[1], _point2[2])
-    path_points.SetNthFiducialPosition(2, _point3[0], _point3[1], _point3[2])
-
-    try:
-      destNode = slicer.util.getNode('pathModel')
-            
-    except slicer.util.MRMLNodeNotFoundException:
-      destNode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
-      destNode.SetName('pathModel')
-      slicer.mrmlScene.AddNode(destNode)
-
-    markupsToModel = slicer.modules.markupstomodel.logic()
-    markupsToModel.UpdateClosedSurfaceModel(path_points, destNode, True)
-    #destNode.GetDisplayNode().SetVisibility(True)
-
-    mtx = vtk.vtkMatrix4x4()
-    mtx_input = vtk.vtkMatrix4x4()
-    zFrameTransform.GetMatrixTransformToWorld(mtx_input)
-    mtx = self.transformZframe(mtx_input)
-
-    mtx.Invert()
-    _input = [_point3[0], _point3[1], _point3[2], 1]
-    entry_z = [0.0, 0.0, 0.0, 1]
-    mtx.MultiplyPoint(_input,entry_z)
-    self.setColorPath(entry_z)
-
-
-  def setColorPath(self,entry):
-    destNode = slicer.util.getNode('pathModel')
-    if entry[0] < LIMITS[0] or entry[0] > LIMITS[1] or entry[1] < LIMITS[2] or entry[1] > LIMITS[3]:
-      destNode.GetDisplayNode().SetColor(1, 0, 0)
+  def setColorPath(self,inside):
+    if inside:
+      self.pathModel.setColor(0, 1, 0)
     else:
-      destNode.GetDisplayNode().SetColor(0, 1, 0)
+      self.pathModel.setColor(1, 0, 0)
 
 
-  def sendAbort(self):
-    try:
-      self.moveText = slicer.util.getNode('ABORT')
-    except:
-      self.moveText = slicer.vtkMRMLTextNode()
-      self.moveText.SetName("ABORT")
-      self.moveText.SetText("ABORT")
-      slicer.mrmlScene.AddNode(self.moveText)
-    if self.cnode.GetState() == 2:
-      self.cnode.RegisterOutgoingMRMLNode(self.moveText)
-      self.cnode.PushNode(self.moveText)
-      time.sleep(0.1)
-      self.cnode.UnregisterOutgoingMRMLNode(self.moveText)    
-      return True
-    else:
-      print(' Connection not stablished, check OpenIGTLink -')
-      return False
+  def sendNode(self,node,callback=None,holdTime=0.1):
+    """Queue a node on the OpenIGTLink connector without blocking.
 
-  def sendMove(self):
-    try:
-      self.moveText = slicer.util.getNode('MOVE')
-    except:
-      self.moveText = slicer.vtkMRMLTextNode()
-      self.moveText.SetName("MOVE")
-      self.moveText.SetText("MOVE")
-      slicer.mrmlScene.AddNode(self.moveText)
-    if self.cnode.GetState() == 2:
-      self.cnode.RegisterOutgoingMRMLNode(self.moveText)
-      self.cnode.PushNode(self.moveText)
-      time.sleep(0.1)
-      self.cnode.UnregisterOutgoingMRMLNode(self.moveText)    
-      return True
-    else:
+    Returns the PendingMessage of the node, whose done callbacks run after
+    its hold time, or False if there is no connection.
+    """
+    message = self.connection.send(node, holdTime, callback)
+    if not message:
       print(' Connection not stablished, check OpenIGTLink -')
-      return False
+    return message
 
-  def sendInit(self):
-    try:
-      self.initText = slicer.util.getNode('INIT')
-    except:
-      self.initText = slicer.vtkMRMLTextNode()
-      self.initText.SetName("INIT")
-      self.initText.SetText("INIT")
-      slicer.mrmlScene.AddNode(self.initText)
-    if self.cnode.GetState() == 2:
-      self.cnode.RegisterOutgoingMRMLNode(self.initText)
-      self.cnode.PushNode(self.initText)
-      time.sleep(0.1)
-      self.cnode.UnregisterOutgoingMRMLNode(self.initText)    
-      return True
-    else:
+  def sendText(self,name,text,callback=None):
+    message = self.connection.sendText(name, text, callback=callback)
+    if not message:
       print(' Connection not stablished, check OpenIGTLink -')
-      return False
+    return message
 
-  def sendReconnect(self):
-    try:
-      self.ReconnectText = slicer.util.getNode('SERIAL')
-    except:
-      self.ReconnectText = slicer.vtkMRMLTextNode()
-      self.ReconnectText.SetName("SERIAL")
-      self.ReconnectText.SetText("SERIAL")
-      slicer.mrmlScene.AddNode(self.ReconnectText)
-    if self.cnode.GetState() == 2:
-      self.cnode.RegisterOutgoingMRMLNode(self.ReconnectText)
-      self.cnode.PushNode(self.ReconnectText)
-      time.sleep(0.1)
-      self.cnode.UnregisterOutgoingMRMLNode(self.ReconnectText)    
-      return True
-    else:
+  def sendAbort(self,clickTime=None):
+    """Push ABORT ahead of any queued command; clickTime (time.perf_counter()) is used to measure the latency."""
+    if not self.connection.isConnected() or not self.connection.abortLane.send(clickTime):
       print(' Connection not stablished, check OpenIGTLink -')
       return False
+    latency = self.connection.abortLane.lastLatency()
+    if latency is not None:
+      logging.info('ABORT pushed %.1f ms after the click' % (latency*1000.0))
+      if latency > self.connection.abortLane.LATENCY_BOUND:
+        logging.warning('ABORT latency above %.0f ms' % (self.connection.abortLane.LATENCY_BOUND*1000.0))
+    return True
 
-  def sendAngle(self,angleTransformation,sliderX,sliderY):
+  def sendMove(self,callback=None):
+    return self.sendText("MOVE", "MOVE", callback)
+
+  def sendInit(self,callback=None):
+    return self.sendText("INIT", "INIT", callback)
+
+  def sendReconnect(self,callback=None):
+    return self.sendText("SERIAL", "SERIAL", callback)
+
+  def sendAngle(self,angleTransformation,sliderX,sliderY,callback=None):
 
     X = sliderX.value
     Y = sliderY.value
@@ -1006,22 +1213,13 @@ class PathPlannerLogic(ScriptedLoadableModuleLogic):
       vTransform.RotateX(X)
       vTransform.RotateY(Y)  
       angleTransformation.SetAndObserveMatrixTransformToParent(vTransform.GetMatrix())
-      
-      if self.cnode.GetState() == 2:
-        self.cnode.RegisterOutgoingMRMLNode(angleTransformation)
-        self.cnode.PushNode(angleTransformation)
-        time.sleep(0.1)
-        self.cnode.UnregisterOutgoingMRMLNode(angleTransformation)    
-        return True
-      else:
-        print(' Connection not stablished yet -')
-        return False
+      return self.sendNode(angleTransformation, callback)
     except:
  #     e = sys.exc_info()
       print('- Check openIGTLink connection-')
       return False
 
-  def sendTarget(self,targetTransformation,ras_target,sliderX,sliderY):
+  def sendTarget(self,ras_target,sliderX,sliderY,callback=None):
     X = -sliderX.value
     Y = -sliderY.value
     try:
@@ -1029,60 +1227,44 @@ class PathPlannerLogic(ScriptedLoadableModuleLogic):
       vTransform.Translate(ras_target[0],ras_target[1],ras_target[2]) 
       vTransform.RotateX(X)
       vTransform.RotateY(Y)     
-      targetTransformation.SetAndObserveMatrixTransformToParent(vTransform.GetMatrix())
-      
-      if self.cnode.GetState() == 2:
-
-        self.cnode.RegisterOutgoingMRMLNode(targetTransformation)
-        self.cnode.PushNode(targetTransformation)
-        time.sleep(0.1)
-        self.cnode.UnregisterOutgoingMRMLNode(targetTransformation)    
-        return True
-      else:
+      message = self.connection.sendTransform("targetTransformation", vTransform.GetMatrix(), callback=callback)
+      if not message:
         print(' Connection not stablished yet -')
-        return False
-    except slicer.util.MRMLNodeNotFoundException:
-      print('- There is no Target on Slicer scene -')
-      return False
+      return message
     except:
       e = sys.exc_info()
       print(e)
       print('- Check openIGTLink connection-')
       return False
 
-  def sendZFrame(self,zFrame):
+  def sendZFrame(self,zFrame,callback=None):
 
     if zFrame:
-      zFrame.SetName("zFrameTransformation")
-      if self.cnode.GetState() == 2:
-        self.cnode.RegisterOutgoingMRMLNode(zFrame)
-        self.cnode.PushNode(zFrame)
-        time.sleep(0.1)
-        self.cnode.UnregisterOutgoingMRMLNode(zFrame) 
-        return True
-      else:
+      mtx = vtk.vtkMatrix4x4()
+      zFrame.GetMatrixTransformToParent(mtx)
+      message = self.connection.sendTransform("zFrameTransformation", mtx, callback=callback)
+      if not message:
         print('- Check openIGTLink connection-')
-        return False
+      return message
     else:
       print('- There is no zFrame on Slicer scene -')
       return False    
 
   def openConnection(self):
 
-    try:
-      slicer.util.getNodesByClass('vtkMRMLIGTLConnectorNode')
-      self.cnode = slicer.util.getNode('OIGTL*')
-      print(' - openIGTLink already open -')
-    except:
-      self.cnode = slicer.vtkMRMLIGTLConnectorNode()
-      slicer.mrmlScene.AddNode(self.cnode)
-      self.cnode.SetTypeClient('192.168.7.2',18944)
-      self.cnode.SetName("OIGTL")
-      self.cnode.Start()
-    
+    self.connection.connect()
     return True
 
-  def createModels(self,labelMapNode, modelHierarchyNode):
+  def createModels(self,labelMapNode,progressCallback=None):
+    """Start building the surface models of the labelmap in the background.
+
+    Returns the model maker CLI node. progressCallback(progress, status, done)
+    is called while the job runs. When it completes, its model hierarchy
+    replaces the previous 'ModelHierarchy'. Planning uses the labelmap voxels
+    (GetCenter, getClearanceMap) and does not wait for the surfaces.
+    """
+    self.discardModelMaker()
+    modelHierarchyNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelHierarchyNode", "ModelHierarchy (building)")
 
     modelMakerCLI = slicer.modules.modelmaker
     # tf = tempfile.NamedTemporaryFile(prefix='Slicer/Models-', suffix='.mrml')
@@ -1103,320 +1285,241 @@ class PathPlannerLogic(ScriptedLoadableModuleLogic):
     modelMakerParameters['PointNormals'] = True
     modelMakerParameters['InputVolume'] = labelMapNode.GetID()
 
-    slicer.cli.run(modelMakerCLI, None, modelMakerParameters, True)
-
-  def GetCenter(self, inputVolume2):
-
-    try:
-      chnode = slicer.util.getNode("Model_1_tissue")
-    except:
-      modelHierarchyNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelHierarchyNode")
-      modelHierarchyNode.SetName("ModelHierarchy")
-      slicer.mrmlScene.AddNode(modelHierarchyNode)
-      self.createModels(inputVolume2, modelHierarchyNode)
-      chnode = slicer.util.getNode("Model_1_tissue")
-    print("test")
-
-    #mnode = chnode.GetAssociatedNode()
-    objectPoly = chnode.GetPolyData()
-    print(chnode)
-    centerOfmass = vtk.vtkCenterOfMass()
-    centerOfmass.SetInputData(objectPoly)
-    centerOfmass.SetUseScalarsAsWeights(False)
-    centerOfmass.Update()
-    #self.Center = centerOfmass.GetCenter()
-    return centerOfmass.GetCenter()
-
-  def transformZframe(self,zFrame):
-    _rotation = vtk.vtkMatrix4x4()
-    _translation = vtk.vtkMatrix4x4()
-
-    _translation.Identity()
-    _translation.SetElement(1,3,107.0)
-    _translation.SetElement(2,3,-114.0)
-
-    _rotation.Identity()
-    _rotation.SetElement(1,1,0.0)
-    _rotation.SetElement(1,2,1.0)
-    _rotation.SetElement(2,1,-1.0)
-    _rotation.SetElement(2,2,0.0)
-
-    _temp = vtk.vtkMatrix4x4()
-    rotatedZframe = vtk.vtkMatrix4x4()
-    
-    vtk.vtkMatrix4x4.Multiply4x4(zFrame, _rotation, _temp)
-    vtk.vtkMatrix4x4.Multiply4x4(_translation, _temp, rotatedZframe)
+    self.modelMakerCallback = progressCallback
+    self.pendingModelHierarchy = modelHierarchyNode
+    self.modelMakerNode = slicer.cli.run(modelMakerCLI, None, modelMakerParameters, False)
+    self.addObserver(self.modelMakerNode, vtk.vtkCommand.ModifiedEvent, self.onModelMakerModified)
+    return self.modelMakerNode
 
-    return rotatedZframe
+  def cancelModels(self):
+    if self.modelMakerNode is not None and self.modelMakerNode.IsBusy():
+      self.modelMakerNode.Cancel()
 
-  def pathStraight(self,selected_target,zFrameTransform):
-
-    mtx = vtk.vtkMatrix4x4()
-    mtx_input = vtk.vtkMatrix4x4()
-    zFrameTransform.GetMatrixTransformToWorld(mtx_input)
-    mtx = self.transformZframe(mtx_input)
+  def discardModelMaker(self):
+    """Stop following the running model maker job and drop its unfinished hierarchy."""
+    if self.modelMakerNode is None:
+      return
+    self.removeObservers(self.onModelMakerModified)
+    self.cancelModels()
+    self.removeModelHierarchy(self.pendingModelHierarchy)
+    self.modelMakerNode = None
+    self.pendingModelHierarchy = None
+
+  def onModelMakerModified(self,cliNode,event=None):
+    done = not cliNode.IsBusy()
+    if done:
+      self.removeObservers(self.onModelMakerModified)
+      if cliNode.GetStatus() == cliNode.Completed:
+        self.removeModelHierarchy(self.modelHierarchyNode)
+        self.modelHierarchyNode = self.pendingModelHierarchy
+        self.modelHierarchyNode.SetName("ModelHierarchy")
+      else:
+        self.removeModelHierarchy(self.pendingModelHierarchy)
+      self.modelMakerNode = None
+      self.pendingModelHierarchy = None
+    if self.modelMakerCallback:
+      self.modelMakerCallback(cliNode.GetProgress(), cliNode.GetStatusString(), done)
+
+  def removeModelHierarchy(self,modelHierarchyNode):
+    if modelHierarchyNode is None or modelHierarchyNode.GetScene() is None:
+      return
+    models = vtk.vtkCollection()
+    modelHierarchyNode.GetChildrenModelNodes(models)
+    for n in range(models.GetNumberOfItems()):
+      slicer.mrmlScene.RemoveNode(models.GetItemAsObject(n))
+    slicer.mrmlScene.RemoveNode(modelHierarchyNode)
 
-    #TODO: check
-    mtx.Invert()
+  def GetCenter(self, labelMapNode, label=1):
+    """Return the RAS centroid of a label (by default 1, the tissue) of the labelmap.
 
-    
-    _input = [selected_target[0], selected_target[1], selected_target[2], 1]
-    target_z = [0.0, 0.0, 0.0, 1]
-    mtx.MultiplyPoint(_input,target_z)
+    The centroids are computed from the voxels and cached until the labelmap
+    changes. Without that label the centroid of all labeled voxels is used.
+    """
+    key = self.labelMapKey(labelMapNode)
+    cached = self.centroidCache.get(labelMapNode.GetID())
+    if cached is None or cached[0] != key:
+      cached = (key, LabelMaps.labelCentroids(slicer.util.arrayFromVolume(labelMapNode), self.getIJKToWorld(labelMapNode)))
+      self.centroidCache[labelMapNode.GetID()] = cached
+    centroids = cached[1]
+    if label in centroids:
+      return centroids[label][0]
+    if not centroids:
+      raise ValueError('Labelmap %s is empty' % labelMapNode.GetName())
+    logging.warning('Label %d not found in %s, using all labels' % (label, labelMapNode.GetName()))
+    counts = np.array([count for center, count in centroids.values()], dtype=float)
+    centers = np.array([center for center, count in centroids.values()])
+    return np.dot(counts, centers)/counts.sum()
+
+  def getClearanceMap(self,labelMapNode):
+    """Return the Clearance.ClearanceMap of the labelmap, or None without labelmap or SciPy.
+
+    The distance transform is computed once and reused until the labelmap
+    node or its voxels are modified.
+    """
+    if labelMapNode is None or labelMapNode.GetImageData() is None:
+      return None
+    if not Clearance.available():
+      logging.warning('SciPy is not available, trajectories are not checked for obstacles')
+      return None
+    key = self.labelMapKey(labelMapNode)
+    if key != self.clearanceKey:
+      self.clearanceMap = Clearance.ClearanceMap(slicer.util.arrayFromVolume(labelMapNode), self.getIJKToWorld(labelMapNode))
+      self.clearanceKey = key
+    return self.clearanceMap
+
+  def labelMapKey(self,labelMapNode):
+    """Return what identifies the current state of a labelmap: node ID and modified times."""
+    return (labelMapNode.GetID(), labelMapNode.GetMTime(), labelMapNode.GetImageData().GetMTime())
+
+  def getIJKToWorld(self,volumeNode):
+    """Return the IJK-to-world matrix of a volume, including its parent transforms, as an array."""
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    if volumeNode.GetParentTransformNode():
+      toWorld = vtk.vtkMatrix4x4()
+      volumeNode.GetParentTransformNode().GetMatrixTransformToWorld(toWorld)
+      ijkToWorld = vtk.vtkMatrix4x4()
+      vtk.vtkMatrix4x4.Multiply4x4(toWorld, ijkToRAS, ijkToWorld)
+      ijkToRAS = ijkToWorld
+    return slicer.util.arrayFromVTKMatrix(ijkToRAS)
+
+  def checkClearance(self,plan,labelMapNode,radius=0.0):
+    """Return (minimum clearance, first collision depth from the entry) of a plan, or None."""
+    clearanceMap = self.getClearanceMap(labelMapNode)
+    if clearanceMap is None:
+      return None
+    return clearanceMap.check(plan.entry, plan.target, radius)
+
+  def searchAngles(self,selected_target,zFrameTransform,labelMapNode=None):
+    """Score the whole coronal/sagittal angle grid for a target (see AngleSearch.searchAngles)."""
+    frame = self.getTemplateFrame(zFrameTransform)
+    return AngleSearch.searchAngles(frame, selected_target, self.getClearanceMap(labelMapNode))
 
-    self.target_z = target_z
+  def transformZframe(self,zFrame):
+    return slicer.util.vtkMatrixFromArray(PlanningCore.templateMatrix(slicer.util.arrayFromVTKMatrix(zFrame)))
 
-    zdist = target_z[2] #add 100, but we need to remove that.
-    try:
-      path_points = slicer.util.getNode('path')
-    except slicer.util.MRMLNodeNotFoundException:
-      path_points = slicer.vtkMRMLMarkupsFiducialNode()
-      path_points.SetName('path')
-      slicer.mrmlScene.AddNode(path_points)
-      target_fiducial = slicer.modules.markups.logic().AddFiducial(0, 0, 0)
-      anatomy_fiducial = slicer.modules.markups.logic().AddFiducial(0,0,0)
-      template_fiducial = slicer.modules.markups.logic().AddFiducial(0,0,0)
-      path_points.SetNthFiducialLabel(0, "target")
-      path_points.SetNthFiducialLabel(1, "anatomy")
-      path_points.SetNthFiducialLabel(2, "insertion")
+  def getTemplateFrame(self,zFrameTransform):
+    """Return the TemplateFrame (forward and inverse template matrices) of the zFrame node.
 
+    The frame is cached and only rebuilt after the node fires ModifiedEvent or
+    TransformModifiedEvent, so replanning does no matrix products or inversions.
+    """
+    if zFrameTransform is not self.templateFrameNode:
+      self.removeObservers(self.onZFrameModified)
+      self.templateFrameNode = zFrameTransform
+      self.addObserver(zFrameTransform, vtk.vtkCommand.ModifiedEvent, self.onZFrameModified)
+      self.addObserver(zFrameTransform, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onZFrameModified)
+      self.onZFrameModified()
+    if self.templateFrame is None:
+      mtx_input = vtk.vtkMatrix4x4()
+      zFrameTransform.GetMatrixTransformToWorld(mtx_input)
+      self.templateFrame = PlanningCore.TemplateFrame(slicer.util.arrayFromVTKMatrix(mtx_input))
+    return self.templateFrame
+
+  def onZFrameModified(self, caller=None, event=None):
+    self.templateFrame = None
+    self.zFrameVersion += 1
+    self.planCache.clear()
+
+  def setSegmentation(self, labelMapNode):
+    """Use labelMapNode as the segmentation, forgetting the plans made with another one or older voxels."""
+    if labelMapNode is not self.segmentationNode:
+      if self.segmentationNode is not None:
+        self.removeObserver(self.segmentationNode, slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onSegmentationModified)
+      self.segmentationNode = labelMapNode
+      if labelMapNode is not None:
+        self.addObserver(labelMapNode, slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onSegmentationModified)
+      self.onSegmentationModified()
+
+  def onSegmentationModified(self, caller=None, event=None):
+    self.planCache.clear()
+
+  def savePlanState(self, angles, guide):
+    """Remember the slider angles and the recommended (guide position, needle length) of the plan shown."""
+    if self.planState is not None:
+      self.planState['angles'] = (float(angles[0]), float(angles[1]))
+      self.planState['guide'] = guide
+
+  def getPathPoints(self):
+    return self.nodes.get('path')
+
+  def createPathPoints(self):
+    path_points = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'path')
+    MarkupsArrays.setPoints(path_points, np.zeros((3, 3)), labels=["target", "anatomy", "insertion"])
+    return path_points
+
+  def showPlan(self,plan):
+    path_points = self.getPathPoints()
     path_points.SetDisplayVisibility(False)
-    center_z = [target_z[0], target_z[1], target_z[2]/2.0, 1.0]
-
-    entry_z = [target_z[0], target_z[1], 0, 1.0]
-
-    count = 0
-    check = self.checkKinematics(entry_z,center_z,target_z,zdist) 
-    if check == 1 or check == 2:
-      entry_z = self.findEntry(entry_z,center_z,target_z)      
-      center_z = [entry_z[0]+(target_z[0]-entry_z[0])/2.0, entry_z[1]+(target_z[1]-entry_z[1])/2.0, target_z[2]/2.0, 1.0]
-    print(entry_z)
-    check = self.checkKinematics(entry_z,center_z,target_z,zdist)
-    if check == 1 or check == 2:
-      center_z = self.findNewCenter(entry_z,center_z,target_z,zdist,check)
-      _diff_R = -(zdist*(center_z[0]-target_z[0]))/(center_z[2]-target_z[2])
-      _diff_A = -(zdist*(center_z[1]-target_z[1]))/(center_z[2]-target_z[2])
-      entry_z = [target_z[0]+_diff_R, target_z[1]+_diff_A, target_z[2]-zdist, 1.0] 
-    print(entry_z)
-
-    entry = [0.0, 0.0, 0.0, 1]
-    center = [0.0, 0.0, 0.0, 1]
-    mtx.Invert()
-    mtx.MultiplyPoint(entry_z,entry)
-    mtx.MultiplyPoint(center_z,center)
-
-    path_points.SetNthFiducialPosition(0, selected_target[0], selected_target[1], selected_target[2])
-    path_points.SetNthFiducialPosition(1, center[0], center[1], center[2])
-    path_points.SetNthFiducialPosition(2, entry[0], entry[1], entry[2])
+    MarkupsArrays.setPoints(path_points, [plan.target, plan.center, plan.entry])
 
-    try:
-      destNode = slicer.util.getNode('pathModel')
-    except:
-      destNode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
-      destNode.SetName('pathModel')
-      slicer.mrmlScene.AddNode(destNode)
-
-    markupsToModel = slicer.modules.markupstomodel.logic()
-    markupsToModel.UpdateClosedSurfaceModel(path_points, destNode, True)
-    destNode.SetDisplayVisibility(True)
+    self.pathModel.update(plan.entry, plan.target)
+    self.pathModel.setColor(0, 1, 0)
+    self.pathModel.setVisibility(True)
 
-    try:
-      modelDisplay = slicer.util.getNode('displayPath')
-      modelDisplay.SetColor(0,1,0)
-    except:
-      modelDisplay = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelDisplayNode')
-      modelDisplay.SetName('displayPath')
-      modelDisplay.SetColor(0,1,0)
-      slicer.mrmlScene.AddNode(modelDisplay)
+  def planTargets(self,targets,zFrameTransform):
+    """Plan straight insertions for all targets at once.
 
+    targets is an (N,3) array of RAS positions or a markups fiducial node.
+    Returns a PlanningCore.PathPlan holding (N,...) arrays of entry points,
+    angles and feasibility codes; plans.insertionLengths() gives the (N,5)
+    insertion lengths for the guide positions DIM1-DIM5. The scene is not
+    modified.
+    """
+    if hasattr(targets, 'GetNumberOfFiducials'):
+      targets = MarkupsArrays.getPoints(targets)
+    return self.getTemplateFrame(zFrameTransform).planTargets(targets)
 
-    modelDisplay.SetSliceIntersectionVisibility(True)
-    modelDisplay.SetSliceIntersectionThickness(3)
-    modelDisplay.SetVisibility(True)
-    destNode.SetAndObserveDisplayNodeID(modelDisplay.GetID())
+  def pathStraight(self,selected_target,zFrameTransform):
 
-    
-#    destNode.GetDisplayNode().SetSliceIntersectionVisibility(True)
-
-    red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
-    red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(slicer.util.getNode('*PROSTATE*').GetID())
-    return target_z[2]
-
-  def findEntry(self,entry,center,target):
-    print(entry)
-    print(target)
-    if target[0] > LIMITS[1]:
-      entry[0] = LIMITS[1]
-    if target[0] < LIMITS[0]:
-      entry[0] = LIMITS[0]
-    if target[1] > LIMITS[3]:
-      entry[1] = LIMITS[3]
-    if target[1] < LIMITS[2]:
-      entry[1] = LIMITS[2]
-    print(entry)
-    print(target)
-    return entry
+    frame = self.getTemplateFrame(zFrameTransform)
+    key = self.planCache.key(selected_target, self.zFrameVersion, 'straight')
+    self.planState = self.planCache.get(key)
+    if self.planState is None:
+      self.planState = {'plan': frame.planStraight(selected_target), 'angles': (0.0, 0.0), 'guide': None}
+      self.planCache.put(key, self.planState)
+    plan = self.planState['plan']
+    if not plan.feasible:
+      logging.info('Target out of the Smart Template workspace (code %d)' % plan.status)
+    self.target_z = plan.targetTemplate
+    self.plan = plan
+    self.showPlan(plan)
+
+    prostate = self.nodes.get('prostate')
+    if prostate is not None:
+      red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
+      red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(prostate.GetID())
+    return plan.depth
 
   def path(self,angleXWidget, angleYWidget,selected_target,labelMapNode,zFrameTransform):
 
-    mtx = vtk.vtkMatrix4x4()
-    mtx_input = vtk.vtkMatrix4x4()
-    zFrameTransform.GetMatrixTransformToWorld(mtx_input)
-    mtx = self.transformZframe(mtx_input)
-
-    mtx.Invert()
-    center = self.GetCenter(labelMapNode)
-    _input = [selected_target[0], selected_target[1], selected_target[2], 1]
-    target_z = [0.0, 0.0, 0.0, 1]
-    mtx.MultiplyPoint(_input,target_z)
-
-    self.target_z = target_z
-
-    _input = [center[0], center[1], center[2], 1]
-    center_z = [0.0, 0.0, 0.0, 1]
-    mtx.MultiplyPoint(_input,center_z)
-    
-    zdist = target_z[2] #add 100, but we need to remove that.
-
-    try:
-      path_points = slicer.util.getNode('path')
-            
-    except slicer.util.MRMLNodeNotFoundException:
-      path_points = slicer.vtkMRMLMarkupsFiducialNode()
-      path_points.SetName('path')
-      slicer.mrmlScene.AddNode(path_points)
-      target_fiducial = slicer.modules.markups.logic().AddFiducial(0, 0, 0)
-      anatomy_fiducial = slicer.modules.markups.logic().AddFiducial(0,0,0)
-      template_fiducial = slicer.modules.markups.logic().AddFiducial(0,0,0)
-      path_points.SetNthFiducialLabel(0, "target")
-      path_points.SetNthFiducialLabel(1, "anatomy")
-      path_points.SetNthFiducialLabel(2, "insertion")
-
-    path_points.SetDisplayVisibility(False)
-    _diff_R = -(zdist*(center_z[0]-target_z[0]))/(center_z[2]-target_z[2])
-    _diff_A = -(zdist*(center_z[1]-target_z[1]))/(center_z[2]-target_z[2])
-
-    entry_z = [target_z[0]+_diff_R, target_z[1]+_diff_A, target_z[2]-zdist, 1.0]
-
-    count = 0
-    check = self.checkKinematics(entry_z,center_z,target_z,zdist) 
-
-    if check == 1 or check == 2:
-      center_z = self.findNewCenter(entry_z,center_z,target_z,zdist,check)
-      _diff_R = -(zdist*(center_z[0]-target_z[0]))/(center_z[2]-target_z[2])
-      _diff_A = -(zdist*(center_z[1]-target_z[1]))/(center_z[2]-target_z[2])
-      entry_z = [target_z[0]+_diff_R, target_z[1]+_diff_A, target_z[2]-zdist, 1.0]       
-    check = self.checkKinematics(entry_z,center_z,target_z,zdist)
-
-    entry = [0.0, 0.0, 0.0, 1]
-    center = [0.0, 0.0, 0.0, 1]
-    mtx.Invert()
-    mtx.MultiplyPoint(entry_z,entry)
-    mtx.MultiplyPoint(center_z,center)
-
-    path_points.SetNthFiducialPosition(0, selected_target[0], selected_target[1], selected_target[2])
-    path_points.SetNthFiducialPosition(1, center[0], center[1], center[2])
-    path_points.SetNthFiducialPosition(2, entry[0], entry[1], entry[2])
-
-    try:
-      destNode = slicer.util.getNode('pathModel')
-    except:
-      destNode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
-      destNode.SetName('pathModel')
-      slicer.mrmlScene.AddNode(destNode)
-
-    markupsToModel = slicer.modules.markupstomodel.logic()
-    markupsToModel.UpdateClosedSurfaceModel(path_points, destNode, True)
-    destNode.SetDisplayVisibility(True) 
-
-    try:
-      modelDisplay = slicer.util.getNode('displayPath')
-      modelDisplay.SetColor(0,1,0)
-    except:
-      modelDisplay = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelDisplayNode')
-      modelDisplay.SetName('displayPath')
-      modelDisplay.SetColor(0,1,0)
-      slicer.mrmlScene.AddNode(modelDisplay)
-
-    modelDisplay.SetSliceIntersectionVisibility(True)
-    modelDisplay.SetSliceIntersectionThickness(3)
-    modelDisplay.SetVisibility(True)
-    destNode.SetAndObserveDisplayNodeID(modelDisplay.GetID())
-
-    angleXWidget.value = -np.arcsin((center[0]-selected_target[0])/(center[2]-selected_target[2]))*(180/3.14)
-    angleYWidget.value = -np.arcsin((center[1]-selected_target[1])/(center[2]-selected_target[2]))*(180/3.14)
+    frame = self.getTemplateFrame(zFrameTransform)
+    # the plan also depends on the segmentation state
+    key = self.planCache.key(selected_target, self.zFrameVersion, 'center', self.labelMapKey(labelMapNode))
+    self.planState = self.planCache.get(key)
+    if self.planState is None:
+      plan = frame.planThroughPoint(selected_target, self.GetCenter(labelMapNode))
+      self.planState = {'plan': plan, 'clearance': self.checkClearance(plan, labelMapNode),
+                        'angles': tuple(PlanningCore.pathAngles(plan.target, plan.center)), 'guide': None}
+      self.planCache.put(key, self.planState)
+    plan, self.clearance = self.planState['plan'], self.planState['clearance']
+    if not plan.feasible:
+      logging.info('Target out of the Smart Template workspace (code %d)' % plan.status)
+    self.target_z = plan.targetTemplate
+    self.plan = plan
+    self.showPlan(plan)
+
+    if self.clearance is not None and not np.isnan(self.clearance[1]):
+      logging.warning('Path crosses the segmentation %.1f mm from the entry' % self.clearance[1])
+
+    angles = self.planState['angles']
+    angleXWidget.value = angles[0]
+    angleYWidget.value = angles[1]
 
 #    red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
 #    red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(slicer.util.getNode('*PROSTATE*').GetID())
-    return zdist
-
-
-  def findNewCenter(self,entry,center,target,zdist,case):
-    if case == 1:
-      if entry[0] < LIMITS[0]:
-        entry[0] = LIMITS[0]
-      if entry[0] > LIMITS[1]:
-        entry[0] = LIMITS[1]
-      if entry[1] < LIMITS[2]:
-        entry[1] = LIMITS[2]
-      if entry[1] > LIMITS[3]:
-        entry[1] = LIMITS[3]
-      _angle1 = (entry[0]-target[0])/zdist
-      _angle2 = (entry[1]-target[1])/zdist
-      print(_angle1)
-      print(_angle2)
-      if _angle1 < -1.0:
-        _angle1 = -1.0
-      if _angle1 > 1.0:
-        _angle1 = 1.0
-      if _angle2 < -1.0:
-        _angle2 = -1.0
-      if _angle2 > 1.0:
-        _angle2 = 1.0
-      angle1 = np.arcsin(_angle1)
-      angle2 = np.arcsin(_angle2)
-      print(angle1)
-      print(angle2)
-    else:
-      _angle1 = (entry[0]-target[0])/zdist
-      _angle2 = (entry[1]-target[1])/zdist
-      if _angle1 < -1.0:
-        _angle1 = -1.0
-      if _angle1 > 1.0:
-        _angle1 = 1.0
-      if _angle2 < -1.0:
-        _angle2 = -1.0
-      if _angle2 > 1.0:
-        _angle2 = 1.0
-      angle1 = np.arcsin(_angle1)
-      angle2 = np.arcsin(_angle2)
-      if angle1 > 0.35:
-        angle1 = 0.35
-      if angle1 < -0.35:
-        angle1 = -0.35
-      if angle2 > 0.35:
-        angle2 = 0.35
-      if angle2 < -0.35:
-        angle2 = -0.35
-    centerNew = [0.0, 0.0, 0.0, 1]
-    centerNew[0] = target[0]+np.sin(angle1)*(target[2]-center[2])
-    centerNew[1] = target[1]+np.sin(angle2)*(target[2]-center[2])
-    centerNew[2] = center[2]
-    return centerNew
-
-  def checkKinematics(self,entry,center,target,zdist):
-    _test1 = np.arcsin((entry[0]-target[0])/zdist)
-    _test2 = np.arcsin((entry[1]-target[1])/zdist)
-    if _test1<-0.35 or _test1>0.35:
-      print("angle limit reached")
-      return 1
-    if entry[0]<LIMITS[0] or entry[0]>LIMITS[1] or entry[1]<LIMITS[2] or entry[1]>LIMITS[3]:
-      print("translation limit reached")
-      return 2
-    
-    print("angle Ok")
-    return 0
- 
+    return plan.depth
+
 
 
 class PathPlannerTest(ScriptedLoadableModuleTest):
@@ -1435,7 +1538,18 @@ class PathPlannerTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
+    self.test_PathPlannerWidget1()
+    self.test_PathPlannerWidget2()
     self.test_PathPlanner1()
+    self.test_PlanningCore1()
+    self.test_PlanningCore2()
+    self.test_ProcedureLogger1()
+    self.test_LabelMaps1()
+    self.test_Clearance1()
+    self.test_AngleSearch1()
+    self.test_MarkupsArrays1()
+    self.test_PathModel1()
+    self.test_BatchPlanning1()
 
   def test_PathPlanner1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -1451,16 +1565,277 @@ class PathPlannerTest(ScriptedLoadableModuleTest):
 
     self.delayDisplay("Starting the test")
     #
-    # first, get some data
+    # a zFrame registration and a target list, no data download needed
     #
-    import SampleData
-    SampleData.downloadFromURL(
-      nodeNames='FA',
-      fileNames='FA.nrrd',
-      uris='http://slicer.kitware.com/midas3/download?items=5767')
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
+    zFrame = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'zFrame')
+    frame = PlanningCore.TemplateFrame(np.identity(4))
+    targets = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'targets')
+    MarkupsArrays.setPoints(targets, frame.toRAS([[5.0, -10.0, 80.0], [40.0, 0.0, 80.0], [80.0, 0.0, 30.0]]))
+
     logic = PathPlannerLogic()
-    self.assertIsNotNone( logic.hasImageData(volumeNode) )
+    plans = logic.planTargets(targets, zFrame)
+    self.assertEqual(list(plans.status), [PlanningCore.FEASIBLE, PlanningCore.FEASIBLE, PlanningCore.ANGLE_LIMIT_REACHED])
+
+    # the Reach column: inside the translation limits the entry is straight above the
+    # target, outside them it is clamped to the limit and angulated, behind the face unreachable
+    status, entry, angles = logic.planReachability(frame.toRAS([[5.0, -10.0, 80.0], [40.0, 0.0, 80.0], [0.0, 0.0, -20.0]]), zFrame)
+    self.assertEqual(list(status), [PlanningCore.FEASIBLE, PlanningCore.FEASIBLE, PlanningCore.DEPTH_LIMIT_REACHED])
+    np.testing.assert_allclose(frame.toTemplate(entry[:2]), [[5.0, -10.0, 0.0], [LIMITS[1], 0.0, 0.0]], atol=1e-9)
+    np.testing.assert_allclose(angles[0], [0.0, 0.0], atol=1e-9)
+    np.testing.assert_allclose(angles[1], [np.arcsin((LIMITS[1] - 40.0)/80.0)/deg2rad, 0.0])
+
+    # re-registering the zFrame updates the same template transform node
+    logic.loadzFrameModel()
+    logic.positionTemplate(zFrame)
+    transformNode = logic.templateTransformNode
+    zFrame.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(np.diag([1.0, 1.0, 1.0, 1.0])))
+    logic.positionTemplate(zFrame)
+    self.assertIs(logic.templateTransformNode, transformNode)
+    self.assertEqual(slicer.mrmlScene.GetNodesByClassByName('vtkMRMLTransformNode', 'TemplateTransform').GetNumberOfItems(), 1)
+    logic.nodes.close()
+    self.delayDisplay('Test passed!')
+
+  def test_PathPlannerWidget1(self):
+    """ The module GUI builds and cleans up without errors.
+    """
+    parent = slicer.qMRMLWidget()
+    parent.setLayout(qt.QVBoxLayout())
+    parent.setMRMLScene(slicer.mrmlScene)
+    widget = PathPlannerWidget(parent)
+    widget.setup()
+    self.assertEqual(len(widget.insertionLabels), 5)
+    self.assertTrue(np.array_equal(widget.parseNeedleLengths(widget.needleLengthsEdit.text), widget.needleLengths))
+    # the command transforms sent to the robot are not offered as zFrame
+    connection = IGTLMessaging.ConnectionManager()
+    connection.setConnector(slicer.mrmlScene.AddNewNodeByClass('vtkMRMLIGTLConnectorNode'))
+    commands = [connection.getOutgoingNode(name) for name in ['targetTransformation', 'zFrameTransformation']]
+    listed = [widget.zFrameSelector.nodeFromIndex(n) for n in range(widget.zFrameSelector.nodeCount())]
+    self.assertFalse(any(node in listed for node in commands))
+    connection.setConnector(None)
+    widget.cleanup()
+    self.delayDisplay('Test passed!')
+
+  def test_PathPlannerWidget2(self):
+    """ Selecting a target again restores the angles and guide position it was left at.
+    """
+    zFrame = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'zFrame')
+    frame = PlanningCore.TemplateFrame(np.identity(4))
+    targets = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'targets')
+    MarkupsArrays.setPoints(targets, frame.toRAS([[5.0, -10.0, 80.0], [-10.0, 5.0, 100.0]]))
+    parent = slicer.qMRMLWidget()
+    parent.setLayout(qt.QVBoxLayout())
+    parent.setMRMLScene(slicer.mrmlScene)
+    widget = PathPlannerWidget(parent)
+    widget.setup()
+    widget.zFrameSelector.setCurrentNode(zFrame)
+    widget.targetSelector.setCurrentNode(targets)
+
+    def select(row):
+      widget.targetTable.setCurrentCell(row, 1)
+      widget.onSelectTarget()
+
+    select(0)
+    widget.angleXWidget.value = 5.0
+    widget.angleYWidget.value = -3.0
+    widget.angleScheduler.flush()
+    guide = widget.logic.planState['guide']
+    self.assertEqual(widget.recommendedGuide, guide[0] if guide else None)
+    select(1)
+    self.assertEqual((widget.angleXWidget.value, widget.angleYWidget.value), (0.0, 0.0))
+    select(0)
+    self.assertEqual((widget.angleXWidget.value, widget.angleYWidget.value), (5.0, -3.0))
+    self.assertEqual(widget.logic.planState['guide'], guide)
+    self.assertEqual(widget.recommendedGuide, guide[0] if guide else None)
+
+    # a new segmentation forgets the remembered states
+    widget.logic.setSegmentation(slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode'))
+    self.assertEqual(len(widget.logic.planCache), 0)
+    widget.cleanup()
+    self.delayDisplay('Test passed!')
+
+  def test_PlanningCore1(self):
+    """ The planning core runs without the scene: plan targets given in
+    template coordinates and check the entry points and feasibility codes.
+    """
+    frame = PlanningCore.TemplateFrame(np.identity(4))
+
+    plan = frame.planStraight(frame.toRAS([5.0, -10.0, 80.0]))
+    self.assertEqual(plan.status, PlanningCore.FEASIBLE)
+    self.assertTrue(np.allclose(plan.entryTemplate, [5.0, -10.0, 0.0]))
+    self.assertAlmostEqual(plan.depth, 80.0)
+
+    # out of the translation limits: the needle is angulated from the limit
+    plan = frame.planStraight(frame.toRAS([40.0, 0.0, 80.0]))
+    self.assertEqual(plan.status, PlanningCore.FEASIBLE)
+    self.assertTrue(np.allclose(plan.entryTemplate, [LIMITS[1], 0.0, 0.0]))
+    self.assertTrue(np.allclose(plan.entry, frame.toRAS(plan.entryTemplate)))
+
+    # too far from the limits for the needle guide angulation
+    plan = frame.planStraight(frame.toRAS([80.0, 0.0, 30.0]))
+    self.assertEqual(plan.status, PlanningCore.ANGLE_LIMIT_REACHED)
+    self.assertTrue(np.allclose(plan.entryTemplate, [LIMITS[1], 0.0, 0.0]))
+
+    # aiming through a point beyond the angle limit stops on the angle limit
+    plan = frame.planThroughPoint(frame.toRAS([0.0, 0.0, 40.0]), frame.toRAS([10.0, 0.0, 20.0]))
+    self.assertEqual(plan.status, PlanningCore.FEASIBLE)
+    self.assertTrue(np.allclose(plan.entryTemplate, [40.0*np.sin(PlanningCore.ANGLE_LIMIT), 0.0, 0.0]))
+
+    # guide positions: the straight candidate wins over the angulated one
+    self.assertEqual(PlanningCore.selectGuidePosition(80.0), (0, 0, 0))
+    self.assertEqual(PlanningCore.selectGuidePosition([80.0, 80.0], [10.0, 0.0]), (1, 0, 0))
+    self.assertIsNone(PlanningCore.selectGuidePosition(-5.0))
+    self.delayDisplay('Test passed!')
+
+  def test_PlanningCore2(self):
+    """ Planning a batch of targets gives the same result as planning them one by one.
+    """
+    frame = PlanningCore.TemplateFrame(np.identity(4))
+    targets = frame.toRAS([[5.0, -10.0, 80.0], [40.0, 0.0, 80.0], [-60.0, 50.0, 40.0], [3.0, 70.0, 30.0]])
+
+    plans = frame.planTargets(targets)
+    self.assertEqual(len(plans), 4)
+    self.assertEqual(plans.insertionLengths().shape, (4, 5))
+    for n in range(len(targets)):
+      plan = frame.planStraight(targets[n])
+      self.assertEqual(plan.status, plans.status[n])
+      self.assertTrue(np.allclose(plan.entry, plans.entry[n]))
+      self.assertTrue(np.allclose(plan.insertionLengths(), plans.insertionLengths()[n]))
+
+    # the plan cache keeps the most recently used plans
+    cache = PlanningCore.PlanCache(maxSize=2)
+    for n in range(3):
+      cache.put(cache.key(targets[n], 0, 'straight'), plans[n])
+    self.assertIsNone(cache.get(cache.key(targets[0], 0, 'straight')))
+    self.assertIs(cache.get(cache.key(targets[2], 0, 'straight')).frame, frame)
+    self.assertIsNone(cache.get(cache.key(targets[2], 1, 'straight')))
+    self.delayDisplay('Test passed!')
+
+  def test_ProcedureLogger1(self):
+    """ Log records reach disk on flush, in session files rotated at maxBytes.
+    """
+    import json, re, tempfile
+    directory = tempfile.mkdtemp()
+    log = ProcedureLogger.ProcedureLogger(directory, prefix="Test", maxBytes=200)
+    for n in range(3):
+      log.log("target_sent", target=np.array([1.0, 2.0, 3.0]), angles=[n, 0])
+    log.log("abort")
+    # flush() as called on abort: everything logged so far is on disk
+    log.flush(timeout=2.0)
+    names = os.listdir(directory)
+    self.assertGreater(len(names), 1)
+    for name in names:
+      self.assertTrue(re.match(r"Test-\d{8}-\d{6}(-\d+)?\.jsonl$", name))
+      self.assertLessEqual(os.path.getsize(os.path.join(directory, name)), 200)
+    def part(name):
+      suffix = name[len("Test-%s" % log.session):-len(".jsonl")]
+      return int(suffix[1:]) if suffix else 0
+    records = []
+    for name in sorted(names, key=part):
+      with open(os.path.join(directory, name)) as f:
+        records += [json.loads(line) for line in f]
+    self.assertEqual([record['event'] for record in records], ["target_sent"]*3 + ["abort"])
+    self.assertEqual(records[2]['angles'], [2, 0])
+    self.assertEqual(records[0]['target'], [1.0, 2.0, 3.0])
+    log.close()
+    self.delayDisplay('Test passed!')
+
+  def test_LabelMaps1(self):
+    """ Label centroids are the mean RAS positions of the voxels of each nonzero label.
+    """
+    labels = np.zeros((4, 5, 6), dtype=np.int16)
+    labels[1, 2, 3] = 1
+    labels[2:4, 0, 0] = 3
+    ijkToRAS = np.diag([2.0, 1.0, 1.0, 1.0])
+    ijkToRAS[:3,3] = [10.0, 0.0, 0.0]
+    centroids = LabelMaps.labelCentroids(labels, ijkToRAS)
+    self.assertEqual(sorted(centroids), [1, 3])
+    np.testing.assert_allclose(centroids[1][0], [16.0, 2.0, 1.0])
+    self.assertEqual(centroids[1][1], 1)
+    np.testing.assert_allclose(centroids[3][0], [10.0, 0.0, 2.5])
+    self.assertEqual(centroids[3][1], 2)
+    self.assertEqual(LabelMaps.labelCentroids(np.zeros((2, 2, 2)), ijkToRAS), {})
+    self.delayDisplay('Test passed!')
+
+  def test_Clearance1(self):
+    """ Segments through an obstacle label report where they hit it, clear ones report NaN.
+    """
+    if not Clearance.available():
+      self.delayDisplay('SciPy not available, skipped')
+      return
+    labels = np.zeros((40, 40, 40), dtype=np.int16)
+    labels[20:25, :, :] = 2
+    clearanceMap = Clearance.ClearanceMap(labels, np.identity(4))
+
+    entry = np.array([[10.0, 10.0, 0.0], [10.0, 10.0, 0.0]])
+    target = np.array([[10.0, 10.0, 35.0], [10.0, 10.0, 15.0]])
+    minimum, depth = clearanceMap.check(entry, target)
+    self.assertEqual(minimum[0], 0.0)
+    self.assertAlmostEqual(depth[0], 20.0, delta=1.0)
+    self.assertAlmostEqual(minimum[1], 5.0, delta=1.0)
+    self.assertTrue(np.isnan(depth[1]))
+    self.delayDisplay('Test passed!')
+
+  def test_AngleSearch1(self):
+    """ The angle search picks the smallest angulation that brings the entry into the translation limits.
+    """
+    frame = PlanningCore.TemplateFrame(np.identity(4))
+    result = AngleSearch.searchAngles(frame, frame.toRAS([30.0, 0.0, 80.0]))
+    self.assertEqual(result.score.shape, (41, 41))
+    self.assertEqual(result.best(), (-4.0, 0.0))
+    self.assertFalse(result.valid[20,20])
+    self.delayDisplay('Test passed!')
+
+  def test_MarkupsArrays1(self):
+    """ Control points are read and written as (N,3) arrays, with one modified event per write.
+    """
+    node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'arrays')
+    MarkupsArrays.setPoints(node, np.zeros((3, 3)), labels=["target", "anatomy", "insertion"])
+    events = []
+    tag = node.AddObserver(vtk.vtkCommand.ModifiedEvent, lambda caller, event: events.append(event))
+    MarkupsArrays.setPoints(node, [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]], start=1)
+    node.RemoveObserver(tag)
+    self.assertEqual(len(events), 1)
+    np.testing.assert_allclose(MarkupsArrays.getPoints(node), [[0, 0, 0], [1, 2, 3], [4, 5, 6]])
+    self.assertEqual(node.GetNthFiducialLabel(2), "insertion")
+    slicer.mrmlScene.RemoveNode(node)
+    self.delayDisplay('Test passed!')
+
+  def test_PathModel1(self):
+    """ Moving the path updates the mesh of its model node.
+    """
+    pathModel = PathModel.PathModel('testPathModel', 'testDisplayPath')
+    pathModel.update([0.0, 0.0, 0.0], [0.0, 0.0, 50.0])
+    node = pathModel.getNode()
+    np.testing.assert_allclose(node.GetPolyData().GetBounds(), [-1, 1, -1, 1, 0, 50], atol=0.1)
+    mtime = node.GetPolyData().GetMTime()
+    pathModel.update([10.0, 0.0, 0.0], [10.0, 0.0, 20.0])
+    self.assertGreater(node.GetPolyData().GetMTime(), mtime)
+    np.testing.assert_allclose(node.GetPolyData().GetBounds(), [9, 11, -1, 1, 0, 20], atol=0.1)
+    slicer.mrmlScene.RemoveNode(node)
+    self.delayDisplay('Test passed!')
+
+  def test_BatchPlanning1(self):
+    """ A case directory is planned offline like the module plans its target list.
+    """
+    import json, tempfile
+    from PathPlannerLib import BatchPlanning
+    caseDirectory = tempfile.mkdtemp()
+    frame = PlanningCore.TemplateFrame(np.identity(4))
+    targets = frame.toRAS([[5.0, -10.0, 80.0], [80.0, 0.0, 30.0], [70.0, 0.0, 120.0]])
+    with open(os.path.join(caseDirectory, 'zFrame.json'), 'w') as f:
+      json.dump({'matrix': np.identity(4).tolist()}, f)
+    with open(os.path.join(caseDirectory, 'targets.json'), 'w') as f:
+      json.dump(targets.tolist(), f)
+    rows = BatchPlanning.planCase(caseDirectory)
+    self.assertEqual(len(rows), 3)
+    status = BatchPlanning.COLUMNS.index('status')
+    self.assertEqual([row[status] for row in rows], [PlanningCore.FEASIBLE] + [PlanningCore.ANGLE_LIMIT_REACHED]*2)
+    length = BatchPlanning.COLUMNS.index('lengthDIM1')
+    self.assertAlmostEqual(rows[0][length], 80.0 + PlanningCore.DIM1)
+    # only reachable targets get a guide recommendation
+    guide = BatchPlanning.COLUMNS.index('guide')
+    self.assertEqual(rows[0][guide], 'DIM1')
+    for row in rows[1:]:
+      self.assertEqual(row[length], '')
+      self.assertEqual(row[guide:guide+2], ['', ''])
     self.delayDisplay('Test passed!')
@@ -0,0 +1,128 @@
+"""Exhaustive search of the needle guide angulation.
+
+Instead of probing one slider position at a time, searchAngles evaluates the
+whole grid of (coronal, sagittal) angle pairs the sliders can reach for a
+target in one vectorized pass: the kinematic feasibility, the insertion length
+and, with a Clearance.ClearanceMap, the obstacle clearance of every
+trajectory. Angles are measured like PlanningCore.entryAngles, in template
+coordinates from the target to the entry on the template face.
+"""
+import numpy as np
+from . import PlanningCore
+
+# slider range and grid step [deg]
+ANGLE_RANGE = 20.0
+ANGLE_STEP = 1.0
+
+# clearance [mm] above which a path is not considered any safer
+CLEARANCE_CAP = 10.0
+
+# score lost per mm of insertion length beyond the straight depth
+LENGTH_WEIGHT = 0.1
+
+
+def angulatedEntries(target_z, anglesX, anglesY):
+  """Return the template face entry points of a target (template coordinates) for the angle pairs [deg]."""
+  target_z = np.asarray(target_z, dtype=float)
+  anglesX, anglesY = np.broadcast_arrays(np.asarray(anglesX, dtype=float), np.asarray(anglesY, dtype=float))
+  entry = np.zeros(anglesX.shape + (3,))
+  entry[...,0] = target_z[0] + target_z[2]*np.sin(anglesX*PlanningCore.deg2rad)
+  entry[...,1] = target_z[1] + target_z[2]*np.sin(anglesY*PlanningCore.deg2rad)
+  return entry
+
+
+class AngleSearchResult(object):
+  """Scores of an angle grid.
+
+  anglesX and anglesY are the grid axes [deg] and depth the target depth;
+  status, length, clearance and score are (len(anglesY), len(anglesX))
+  arrays. Infeasible or colliding pairs score -inf. clearance is None when
+  no clearance map was given.
+  """
+
+  def __init__(self, anglesX, anglesY, depth, status, length, clearance, collision, score):
+    self.anglesX = anglesX
+    self.depth = depth
+    self.anglesY = anglesY
+    self.status = status
+    self.length = length
+    self.clearance = clearance
+    self.collision = collision
+    self.score = score
+
+  @property
+  def valid(self):
+    return np.isfinite(self.score)
+
+  def bestIndex(self):
+    """Return the (row, column) of the best pair, or None if no pair is valid."""
+    if not self.valid.any():
+      return None
+    return np.unravel_index(np.argmax(self.score), self.score.shape)
+
+  def best(self):
+    """Return the best (coronal, sagittal) angle pair, or None."""
+    index = self.bestIndex()
+    if index is None:
+      return None
+    return self.anglesX[index[1]], self.anglesY[index[0]]
+
+  def guidePosition(self, needleLengths=PlanningCore.NEEDLE_LENGTHS, tolerance=PlanningCore.DEPTH_TOLERANCE):
+    """Return (coronal, sagittal, guide position, needle) of the valid pair with the
+    smallest angulation that has a guide position (PlanningCore.selectGuidePosition), or None."""
+    rows, columns = np.nonzero(self.valid)
+    choice = PlanningCore.selectGuidePosition(self.depth, self.anglesX[columns], self.anglesY[rows], needleLengths, tolerance)
+    if choice is None:
+      return None
+    candidate, position, needle = choice
+    return self.anglesX[columns[candidate]], self.anglesY[rows[candidate]], position, needle
+
+
+def searchAngles(frame, target, clearanceMap=None, radius=0.0, angleRange=ANGLE_RANGE, step=ANGLE_STEP):
+  """Score every angle pair of the grid for a RAS target.
+
+  frame is the PlanningCore.TemplateFrame of the template. Pairs are
+  feasible when checkKinematics accepts the entry and, with a clearance
+  map, the trajectory keeps more than radius mm from the obstacles. The
+  score prefers clearance (up to CLEARANCE_CAP) and short insertions.
+  """
+  axis = np.arange(-angleRange, angleRange + step/2.0, step)
+  anglesY, anglesX = np.meshgrid(axis, axis, indexing='ij')
+  target = np.asarray(target, dtype=float)[:3]
+  target_z = frame.toTemplate(target)
+  depth = target_z[2]
+  entry_z = angulatedEntries(target_z, anglesX, anglesY)
+  entry = frame.toRAS(entry_z)
+
+  status = PlanningCore.checkKinematics(entry_z, target_z*np.ones_like(entry_z), depth*np.ones(anglesX.shape))
+  length = PlanningCore.insertionLengths(depth, anglesX, anglesY)[...,0] - PlanningCore.GUIDE_OFFSETS[0]
+
+  score = -LENGTH_WEIGHT*(length - depth)
+  clearance = None
+  collision = np.zeros(anglesX.shape, dtype=bool)
+  if clearanceMap is not None:
+    clearance, depthOfCollision = clearanceMap.check(entry, target*np.ones_like(entry), radius)
+    collision = ~np.isnan(depthOfCollision)
+    score = score + np.minimum(clearance, CLEARANCE_CAP)
+  score = np.where((status == PlanningCore.FEASIBLE) & ~collision, score, -np.inf)
+  return AngleSearchResult(axis, axis, depth, status, length, clearance, collision, score)
+
+
+def heatmapColors(result):
+  """Return the 0xAARRGGBB colors of the grid cells: red to green by score, gray
+  for kinematically infeasible pairs, dark red for collisions and white for
+  the best pair."""
+  valid = result.valid
+  value = np.zeros(result.score.shape)
+  if valid.any():
+    low = result.score[valid].min()
+    high = result.score[valid].max()
+    value[valid] = (result.score[valid] - low)/(high - low) if high > low else 1.0
+  red = np.where(valid, 255*(1.0 - value), np.where(result.collision, 120, 160)).astype(np.uint32)
+  green = np.where(valid, 255*value, np.where(result.collision, 0, 160)).astype(np.uint32)
+  blue = np.where(valid, 0, np.where(result.collision, 0, 160)).astype(np.uint32)
+  colors = 0xFF000000 | (red << 16) | (green << 8) | blue
+  index = result.bestIndex()
+  if index is not None:
+    colors[index] = 0xFFFFFFFF
+  return colors
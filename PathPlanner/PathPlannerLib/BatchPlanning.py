@@ -0,0 +1,248 @@
+"""Offline batch planning of past cases.
+
+Replays the straight-insertion planning of PathPlannerLogic on case
+directories, without Slicer. Each case directory holds a zFrame registration
+(a file with 'zframe' in its name: .json, .txt or .tfm) and one or more target
+lists (.fcsv or .json markups files). Cases are planned in a process pool and
+all targets of the run are written to one CSV file:
+
+  cd PathPlanner
+  python -m PathPlannerLib.BatchPlanning cases/* -o study.csv --jobs 8
+
+A .json zFrame holds the 4x4 zFrame-to-RAS matrix as a nested list, either
+alone or under the key "matrix"; a .txt zFrame holds it as 4 rows of numbers.
+.tfm files (and .txt files starting with the ITK header) are read like Slicer
+writes linear transforms: the transform from parent, in LPS.
+"""
+import argparse
+import csv
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+from datetime import datetime
+
+import numpy as np
+
+from . import PlanningCore
+
+ZFRAME_EXTENSIONS = ('.json', '.txt', '.tfm')
+TARGET_EXTENSIONS = ('.fcsv', '.json')
+
+# RAS <-> LPS
+_LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+GUIDE_NAMES = ['DIM1', 'DIM2', 'DIM3', 'DIM4', 'DIM5']
+
+COLUMNS = (['case', 'targetFile', 'label', 'targetR', 'targetA', 'targetS', 'entryR', 'entryA', 'entryS',
+            'angleX', 'angleY', 'depth', 'status', 'statusName']
+           + ['length%s' % name for name in GUIDE_NAMES] + ['guide', 'needle'])
+
+
+def readITKTransform(path):
+  """Return the 4x4 RAS to-parent matrix of the first linear transform of an ITK text file."""
+  parameters = fixed = None
+  with open(path) as f:
+    for line in f:
+      key, _, value = line.partition(':')
+      if key.strip() == 'Transform' and parameters is not None:
+        break
+      if key.strip() == 'Parameters':
+        parameters = [float(v) for v in value.split()]
+      elif key.strip() == 'FixedParameters':
+        fixed = [float(v) for v in value.split()]
+  if parameters is None or len(parameters) != 12:
+    raise ValueError("%s: no 3D linear transform found" % path)
+  rotation = np.array(parameters[:9]).reshape(3, 3)
+  center = np.array(fixed[:3]) if fixed else np.zeros(3)
+  fromParent = np.identity(4)
+  fromParent[:3,:3] = rotation
+  fromParent[:3,3] = np.array(parameters[9:]) + center - np.dot(rotation, center)
+  return np.linalg.inv(np.dot(_LPS, np.dot(fromParent, _LPS)))
+
+
+def readZFrame(path):
+  """Return the 4x4 zFrame-to-RAS matrix stored in a .json, .txt or .tfm file."""
+  extension = os.path.splitext(path)[1].lower()
+  if extension == '.tfm':
+    return readITKTransform(path)
+  if extension == '.json':
+    with open(path) as f:
+      data = json.load(f)
+    matrix = np.array(data['matrix'] if isinstance(data, dict) else data, dtype=float)
+  else:
+    with open(path) as f:
+      if f.readline().startswith('#Insight Transform File'):
+        return readITKTransform(path)
+    matrix = np.loadtxt(path, dtype=float, ndmin=2)
+  if matrix.size == 12:
+    matrix = np.vstack([matrix.reshape(3, 4), [0.0, 0.0, 0.0, 1.0]])
+  if matrix.size != 16:
+    raise ValueError("%s: expected a 4x4 matrix" % path)
+  return matrix.reshape(4, 4)
+
+
+def readFCSV(path):
+  """Return the (labels, (N,3) RAS points) of a Slicer markups .fcsv file."""
+  columns = ['id', 'x', 'y', 'z']
+  lps = False
+  labels = []
+  points = []
+  with open(path) as f:
+    for row in csv.reader(f):
+      if not row:
+        continue
+      if row[0].startswith('#'):
+        header = ','.join(row).lstrip('#').strip()
+        key, _, value = header.partition('=')
+        if key.strip() == 'CoordinateSystem':
+          lps = value.strip() in ('1', 'LPS')
+        elif key.strip() == 'columns':
+          columns = [column.strip() for column in value.split(',')]
+        continue
+      fields = dict(zip(columns, row))
+      points.append([float(fields['x']), float(fields['y']), float(fields['z'])])
+      labels.append(fields.get('label', str(len(labels))))
+  points = np.array(points, dtype=float).reshape(-1, 3)
+  if lps:
+    points[:,:2] *= -1
+  return labels, points
+
+
+def readMarkupsJSON(path):
+  """Return the (labels, (N,3) RAS points) of a Slicer .mrk.json file or a plain list of points."""
+  with open(path) as f:
+    data = json.load(f)
+  labels = []
+  points = []
+  if isinstance(data, dict):
+    for markup in data.get('markups', []):
+      lps = markup.get('coordinateSystem', 'LPS') == 'LPS'
+      for point in markup.get('controlPoints', []):
+        position = np.array(point['position'], dtype=float)
+        if lps:
+          position[:2] *= -1
+        points.append(position)
+        labels.append(point.get('label', str(len(labels))))
+  else:
+    points = data
+    labels = [str(n) for n in range(len(points))]
+  return labels, np.array(points, dtype=float).reshape(-1, 3)
+
+
+def readTargets(path):
+  if path.lower().endswith('.fcsv'):
+    return readFCSV(path)
+  return readMarkupsJSON(path)
+
+
+def findCaseFiles(caseDirectory):
+  """Return the zFrame file and the target files of a case directory."""
+  if not os.path.isdir(caseDirectory):
+    raise ValueError("%s: not a case directory" % caseDirectory)
+  zFrame = None
+  targets = []
+  for name in sorted(os.listdir(caseDirectory)):
+    path = os.path.join(caseDirectory, name)
+    extension = os.path.splitext(name)[1].lower()
+    if 'zframe' in name.lower() and extension in ZFRAME_EXTENSIONS:
+      zFrame = zFrame or path
+    elif extension in TARGET_EXTENSIONS:
+      targets.append(path)
+  if zFrame is None:
+    raise ValueError("%s: no zFrame file" % caseDirectory)
+  return zFrame, targets
+
+
+def planCase(caseDirectory, needleLengths=PlanningCore.NEEDLE_LENGTHS, tolerance=PlanningCore.DEPTH_TOLERANCE):
+  """Plan all targets of a case directory; return the result rows (lists in COLUMNS order).
+
+  The guide position is recommended for needles of needleLengths [mm] with
+  an overshoot of up to tolerance [mm] (PlanningCore.selectGuidePosition).
+  """
+  zFrame, targetFiles = findCaseFiles(caseDirectory)
+  frame = PlanningCore.TemplateFrame(readZFrame(zFrame))
+  case = os.path.basename(os.path.normpath(caseDirectory))
+  rows = []
+  for targetFile in targetFiles:
+    labels, targets = readTargets(targetFile)
+    if len(targets) == 0:
+      continue
+    plans = frame.planTargets(targets)
+    lengths = plans.insertionLengths()
+    for n, label in enumerate(labels):
+      status = int(plans.status[n])
+      guide = None
+      if status == PlanningCore.FEASIBLE:
+        guide = PlanningCore.selectGuidePosition(plans.depth[n], plans.angles[n,0], plans.angles[n,1], needleLengths, tolerance)
+      angles = list(plans.angles[n])
+      # targets behind the template have no path, and arcsin clips the angles of paths past 90 degrees
+      if status == PlanningCore.DEPTH_LIMIT_REACHED or not np.all(np.abs(plans.angles[n]) < 90.0):
+        angles = ['', '']
+      rows.append([case, os.path.basename(targetFile), label]
+                  + list(plans.target[n]) + list(plans.entry[n]) + angles
+                  + [plans.depth[n], status, PlanningCore.STATUS_NAMES[status]]
+                  # unreachable targets get neither lengths nor a guide recommendation
+                  + (list(lengths[n]) if status == PlanningCore.FEASIBLE else ['']*len(GUIDE_NAMES))
+                  + ([GUIDE_NAMES[guide[1]], '%g' % needleLengths[guide[2]]] if guide else ['', '']))
+  return rows
+
+
+def _planCase(caseDirectory, **options):
+  # pool worker: errors are reported per case instead of stopping the run
+  try:
+    return caseDirectory, planCase(caseDirectory, **options), None
+  except Exception:
+    return caseDirectory, [], traceback.format_exc()
+
+
+def _format(value):
+  if isinstance(value, (float, np.floating)):
+    return '%.3f' % value
+  return value
+
+
+def run(caseDirectories, output, jobs=None, **options):
+  """Plan the cases in a pool of jobs processes and write the rows to output; return the failed cases.
+
+  options are passed on to planCase.
+  """
+  failed = []
+  pool = multiprocessing.Pool(jobs)
+  try:
+    with open(output, 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(COLUMNS)
+      for caseDirectory, rows, error in pool.imap(functools.partial(_planCase, **options), caseDirectories):
+        if error:
+          failed.append(caseDirectory)
+          sys.stderr.write("%s failed:\n%s" % (caseDirectory, error))
+        writer.writerows([_format(value) for value in row] for row in rows)
+  finally:
+    pool.close()
+    pool.join()
+  return failed
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Plan the targets of past Smart Template cases offline")
+  parser.add_argument('cases', nargs='+', help="case directories (zFrame and target files)")
+  parser.add_argument('-o', '--output', default=None, help="results CSV file (default: batchPlan-<time>.csv)")
+  parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: one per CPU)")
+  parser.add_argument('--needle-lengths', type=float, nargs='+', default=list(PlanningCore.NEEDLE_LENGTHS),
+                      help="lengths [mm] of the available needles (default: the PlanningCore placeholders)")
+  parser.add_argument('--tolerance', type=float, default=PlanningCore.DEPTH_TOLERANCE,
+                      help="how far [mm] a needle inserted up to its hub may pass the target")
+  args = parser.parse_args(argv)
+
+  output = args.output or 'batchPlan-%s.csv' % datetime.now().strftime("%Y%m%d-%H%M%S")
+  # missing cases are reported as failed by the workers
+  failed = run(args.cases, output, args.jobs, needleLengths=args.needle_lengths, tolerance=args.tolerance)
+  print('%d cases planned, %d failed, results in %s' % (len(args.cases) - len(failed), len(failed), output))
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,81 @@
+"""Obstacle clearance of needle trajectories.
+
+ClearanceMap holds the Euclidean distance [mm] from every voxel of a labelmap
+to the nearest obstacle voxel. It is computed once per segmentation; checking
+a trajectory is then a lookup of that distance at points sampled along the
+target/entry segment, done for all the candidate segments at once. The
+distance transform needs scipy.ndimage; without SciPy no map is built.
+"""
+import numpy as np
+
+try:
+  from scipy import ndimage
+except ImportError:
+  ndimage = None
+
+# labels the needle may go through: background and the tissue it aims at
+PASSABLE_LABELS = (0, 1)
+
+# clearance reported for points outside the labelmap [mm]
+OUTSIDE_CLEARANCE = np.inf
+
+
+def available():
+  return ndimage is not None
+
+
+class ClearanceMap(object):
+  """Distance field of the obstacles of a labelmap.
+
+  labels is the labelmap voxel array in KJI order (as slicer.util.arrayFromVolume
+  returns it) and ijkToRAS its 4x4 IJK-to-RAS matrix. Every label that is not
+  in passableLabels is an obstacle.
+  """
+
+  def __init__(self, labels, ijkToRAS, passableLabels=PASSABLE_LABELS):
+    if ndimage is None:
+      raise ImportError("ClearanceMap needs scipy.ndimage")
+    labels = np.asarray(labels)
+    self.ijkToRAS = np.array(ijkToRAS, dtype=float)
+    self.rasToIJK = np.linalg.inv(self.ijkToRAS)
+    self.shape = labels.shape
+    obstacles = ~np.isin(labels, passableLabels)
+    spacing = np.linalg.norm(self.ijkToRAS[:3,:3], axis=0)
+    if obstacles.any():
+      # distance_transform_edt measures the distance to the nearest zero voxel
+      self.distance = ndimage.distance_transform_edt(~obstacles, sampling=spacing[::-1]).astype(np.float32)
+    else:
+      self.distance = np.full(self.shape, np.inf, dtype=np.float32)
+
+  def sample(self, points):
+    """Return the clearance at (..., 3) RAS points (nearest voxel)."""
+    points = np.asarray(points, dtype=float)
+    ijk = np.rint(np.dot(points, self.rasToIJK[:3,:3].T) + self.rasToIJK[:3,3]).astype(int)
+    kji = ijk[...,::-1]
+    inside = np.all((kji >= 0) & (kji < self.shape), axis=-1)
+    kji = np.clip(kji, 0, np.array(self.shape) - 1)
+    values = self.distance[kji[...,0], kji[...,1], kji[...,2]]
+    return np.where(inside, values, OUTSIDE_CLEARANCE)
+
+  def check(self, entry, target, radius=0.0, step=1.0):
+    """Return (minimum clearance, first collision depth) of entry/target segments.
+
+    entry and target are (3,) or (N,3) RAS points. The segments are sampled
+    every step mm from the entry to the target. The collision depth is the
+    distance from the entry to the first sample closer than radius to an
+    obstacle, or NaN when the segment is clear.
+    """
+    entry = np.asarray(entry, dtype=float)
+    target = np.asarray(target, dtype=float)
+    direction = target - entry
+    length = np.linalg.norm(direction, axis=-1)
+    samples = max(2, int(np.ceil(np.max(length)/step)) + 1)
+    fraction = np.linspace(0.0, 1.0, samples)
+    points = entry[...,None,:] + fraction[:,None]*direction[...,None,:]
+    clearance = self.sample(points)
+
+    collision = clearance <= radius
+    hit = collision.any(axis=-1)
+    first = np.argmax(collision, axis=-1)
+    depth = np.where(hit, fraction[first]*length, np.nan)
+    return clearance.min(axis=-1), depth
@@ -0,0 +1,279 @@
+"""OpenIGTLink connection and non-blocking outgoing messages.
+
+Sending a node through a vtkMRMLIGTLConnectorNode means registering it as an
+outgoing node, pushing it and unregistering it once the message is out. The
+modules used to sleep between push and unregister, which froze the Qt event
+loop for every command. OutgoingMessageQueue pushes queued nodes from the
+event loop and unregisters them from a timer, handing a PendingMessage back to
+the caller instead. ConnectionManager shares one connector, its queue and
+its registered command nodes between the Homing and PathPlanner modules.
+"""
+import collections
+import time
+import vtk, qt, slicer
+
+
+class PendingMessage(object):
+  """Future of a message sent through an OutgoingMessageQueue.
+
+  result is None while the message is queued, True once it was pushed and
+  False if it could not be pushed. Done callbacks are called with the
+  message once its hold time is over (or the push failed).
+  """
+
+  def __init__(self, node, holdTime):
+    self.node = node
+    self.holdTime = holdTime
+    self.result = None
+    self.queuedTime = time.time()
+    self.pushedTime = None
+    self.finished = False
+    self.callbacks = []
+
+  def done(self):
+    return self.finished
+
+  def addDoneCallback(self, callback):
+    if self.finished:
+      callback(self)
+    else:
+      self.callbacks.append(callback)
+
+  def _finish(self):
+    self.finished = True
+    for callback in self.callbacks:
+      callback(self)
+    self.callbacks = []
+
+
+class OutgoingMessageQueue(object):
+  """Pushes MRML nodes through an OpenIGTLink connector without blocking.
+
+  send() queues the node and returns right away; the queue is drained on
+  the next event loop iteration in FIFO order. Each node stays registered
+  for its hold time and is unregistered from a timer, so several commands
+  can go out in a row without waiting for each other.
+  """
+
+  def __init__(self, connector):
+    self.connector = connector
+    self.queue = collections.deque()
+    self.registrations = {}
+    self.processScheduled = False
+
+  def isConnected(self):
+    return self.connector is not None and self.connector.GetState() == slicer.vtkMRMLIGTLConnectorNode.StateConnected
+
+  def send(self, node, holdTime=0.1, callback=None):
+    """Queue node for sending and return its PendingMessage."""
+    message = PendingMessage(node, holdTime)
+    if callback:
+      message.addDoneCallback(callback)
+    self.queue.append(message)
+    if not self.processScheduled:
+      self.processScheduled = True
+      qt.QTimer.singleShot(0, self.process)
+    return message
+
+  def cancelPending(self):
+    """Drop the messages that were queued but not pushed yet."""
+    while self.queue:
+      message = self.queue.popleft()
+      message.result = False
+      message._finish()
+
+  def process(self):
+    self.processScheduled = False
+    while self.queue:
+      self.push(self.queue.popleft())
+
+  def push(self, message):
+    if not self.isConnected():
+      message.result = False
+      message._finish()
+      return
+    nodeID = message.node.GetID()
+    if not self.registrations.get(nodeID):
+      self.connector.RegisterOutgoingMRMLNode(message.node)
+    self.registrations[nodeID] = self.registrations.get(nodeID, 0) + 1
+    self.connector.PushNode(message.node)
+    message.pushedTime = time.time()
+    message.result = True
+    qt.QTimer.singleShot(int(message.holdTime*1000), lambda: self.release(message))
+
+  def release(self, message):
+    nodeID = message.node.GetID()
+    self.registrations[nodeID] -= 1
+    if not self.registrations[nodeID]:
+      del self.registrations[nodeID]
+      self.connector.UnregisterOutgoingMRMLNode(message.node)
+    message._finish()
+
+
+class AbortLane(object):
+  """Fast lane for the ABORT command.
+
+  node is the ABORT text node, already registered on the connector of the
+  queue. send() pushes it synchronously from the caller, ahead of everything
+  in the outgoing queue, and drops the commands still waiting there so
+  nothing queued before the abort goes out after it. The time from the
+  user's click to the push is recorded in latencies (seconds).
+  """
+
+  # abort pushes slower than this are reported
+  LATENCY_BOUND = 0.010
+
+  def __init__(self, queue, node):
+    self.queue = queue
+    self.node = node
+    self.latencies = collections.deque(maxlen=100)
+
+  def send(self, clickTime=None):
+    """Push ABORT now; clickTime is the time.perf_counter() value of the user action."""
+    if not self.queue.isConnected():
+      return False
+    self.queue.connector.PushNode(self.node)
+    pushedTime = time.perf_counter()
+    self.queue.cancelPending()
+    if clickTime is not None:
+      self.latencies.append(pushedTime - clickTime)
+    return True
+
+  def lastLatency(self):
+    return self.latencies[-1] if self.latencies else None
+
+
+def setQuietly(node, update):
+  """Call update() with the modified events of node disabled.
+
+  The connector pushes a registered outgoing node whenever it is modified,
+  so changing the content of a command node would send it at once, ahead
+  of (and in addition to) the push queued by send().
+  """
+  wasDisabled = node.GetDisableModifiedEvent()
+  node.SetDisableModifiedEvent(True)
+  try:
+    update()
+  finally:
+    node.SetDisableModifiedEvent(wasDisabled)
+
+
+class ConnectionManager(object):
+  """OpenIGTLink connection shared by the Homing and PathPlanner modules.
+
+  Holds the connector node, keeps the outgoing command nodes (OUTGOING_NODES)
+  registered on it for the whole session and caches the connector state from
+  its events, so the modules neither look the connector up nor register and
+  unregister nodes for every command. Use ConnectionManager.instance().
+  """
+
+  OUTGOING_NODES = {
+    'INIT': 'vtkMRMLTextNode',
+    'MOVE': 'vtkMRMLTextNode',
+    'ABORT': 'vtkMRMLTextNode',
+    'SERIAL': 'vtkMRMLTextNode',
+    'targetTransformation': 'vtkMRMLLinearTransformNode',
+    'zFrameTransformation': 'vtkMRMLLinearTransformNode',
+    }
+
+  _instance = None
+
+  @classmethod
+  def instance(cls):
+    if cls._instance is None:
+      cls._instance = cls()
+    return cls._instance
+
+  def __init__(self):
+    self.connector = None
+    self.queue = None
+    self.abortLane = None
+    self.outgoingNodes = {}
+    self.state = slicer.vtkMRMLIGTLConnectorNode.StateOff
+    self.observerTags = []
+
+  def getConnector(self):
+    """Return the connector in use, picking up one that already exists in the scene."""
+    if self.connector is not None and self.connector.GetScene() is None:
+      self.setConnector(None)
+    if self.connector is None:
+      connectors = slicer.util.getNodesByClass('vtkMRMLIGTLConnectorNode')
+      named = [connector for connector in connectors if connector.GetName().startswith('OIGTL')]
+      if named or connectors:
+        self.setConnector((named or connectors)[0])
+    return self.connector
+
+  def connect(self, host='192.168.7.2', port=18944):
+    if self.getConnector() is None:
+      connector = slicer.vtkMRMLIGTLConnectorNode()
+      connector.SetName("OIGTL")
+      slicer.mrmlScene.AddNode(connector)
+      connector.SetTypeClient(host, port)
+      self.setConnector(connector)
+      connector.Start()
+    return self.connector
+
+  def setConnector(self, connector):
+    for node, tag in self.observerTags:
+      node.RemoveObserver(tag)
+    self.observerTags = []
+    self.connector = connector
+    self.outgoingNodes = {}
+    self.queue = None
+    self.abortLane = None
+    if connector is None:
+      self.state = slicer.vtkMRMLIGTLConnectorNode.StateOff
+      return
+    for event in [vtk.vtkCommand.ModifiedEvent,
+                  slicer.vtkMRMLIGTLConnectorNode.ConnectedEvent, slicer.vtkMRMLIGTLConnectorNode.DisconnectedEvent,
+                  slicer.vtkMRMLIGTLConnectorNode.ActivatedEvent, slicer.vtkMRMLIGTLConnectorNode.DeactivatedEvent]:
+      self.observerTags.append((connector, connector.AddObserver(event, self.onConnectorEvent)))
+    self.state = connector.GetState()
+    self.queue = OutgoingMessageQueue(connector)
+    for name in self.OUTGOING_NODES:
+      self.getOutgoingNode(name)
+    self.abortLane = AbortLane(self.queue, self.outgoingNodes['ABORT'])
+
+  def onConnectorEvent(self, caller, event):
+    self.state = caller.GetState()
+
+  def isConnected(self):
+    return self.getConnector() is not None and self.state == slicer.vtkMRMLIGTLConnectorNode.StateConnected
+
+  def getOutgoingNode(self, name):
+    """Return the outgoing node called name, registered on the connector for good."""
+    node = self.outgoingNodes.get(name)
+    if node is None or node.GetScene() is None:
+      className = self.OUTGOING_NODES[name]
+      node = slicer.mrmlScene.GetFirstNodeByName(name)
+      if node is None or not node.IsA(className):
+        node = slicer.mrmlScene.AddNewNodeByClass(className, name)
+        if className == 'vtkMRMLTextNode':
+          node.SetText(name)
+      # command nodes are not for the user: keep them out of node selectors (e.g. the zFrame one)
+      node.SetHideFromEditors(True)
+      self.connector.RegisterOutgoingMRMLNode(node)
+      # a registration the queue never releases
+      self.queue.registrations[node.GetID()] = 1
+      self.outgoingNodes[name] = node
+    return node
+
+  def send(self, node, holdTime=0.1, callback=None):
+    """Queue node for sending; returns its PendingMessage, or False without connection."""
+    if not self.isConnected():
+      return False
+    return self.queue.send(node, holdTime, callback)
+
+  def sendText(self, name, text, holdTime=0.1, callback=None):
+    if not self.isConnected():
+      return False
+    node = self.getOutgoingNode(name)
+    setQuietly(node, lambda: node.SetText(text))
+    return self.queue.send(node, holdTime, callback)
+
+  def sendTransform(self, name, matrix, holdTime=0.1, callback=None):
+    if not self.isConnected():
+      return False
+    node = self.getOutgoingNode(name)
+    setQuietly(node, lambda: node.SetMatrixTransformToParent(matrix))
+    return self.queue.send(node, holdTime, callback)
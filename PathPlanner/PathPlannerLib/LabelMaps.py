@@ -0,0 +1,27 @@
+"""Statistics of labelmap voxels.
+
+Works on the voxel arrays of slicer.util.arrayFromVolume (KJI order) and the
+IJK-to-RAS matrix of the volume, without building surface models.
+"""
+import numpy as np
+
+
+def labelCentroids(labels, ijkToRAS):
+  """Return {label: (RAS centroid, voxel count)} for every nonzero label.
+
+  Only the labeled voxels are visited: their flat indices are unraveled once
+  and the coordinates of each label summed with np.bincount.
+  """
+  labels = np.asarray(labels)
+  flat = labels.ravel()
+  index = np.flatnonzero(flat)
+  if len(index) == 0:
+    return {}
+  values = flat[index].astype(np.intp)
+  counts = np.bincount(values)
+  kji = np.unravel_index(index, labels.shape)
+  sums = np.stack([np.bincount(values, weights=kji[axis], minlength=len(counts)) for axis in (2, 1, 0)], axis=1)
+  present = np.flatnonzero(counts)
+  ijk = sums[present]/counts[present][:,None]
+  ras = np.dot(ijk, np.asarray(ijkToRAS)[:3,:3].T) + np.asarray(ijkToRAS)[:3,3]
+  return dict((int(label), (ras[n], int(counts[label]))) for n, label in enumerate(present))
@@ -0,0 +1,56 @@
+"""(N,3) NumPy access to the control points of markups fiducial nodes.
+
+The planner used to read and write the 'path' and target fiducials one
+coordinate list at a time, and every SetNthFiducialPosition fired its own
+modified event. getPoints returns all positions as one float64 array and
+setPoints writes an array inside a single StartModify/EndModify, so observers
+see one update per change however many points it moves.
+"""
+import numpy as np
+import slicer
+
+
+def getPoints(node):
+  """Return the (N,3) float64 RAS positions of the control points of node."""
+  if node is None:
+    return np.zeros((0, 3))
+  if hasattr(slicer.util, 'arrayFromMarkupsControlPoints'):
+    return np.asarray(slicer.util.arrayFromMarkupsControlPoints(node), dtype=np.float64).reshape(-1, 3)
+  points = np.zeros((node.GetNumberOfFiducials(), 3))
+  position = [0.0, 0.0, 0.0]
+  for n in range(len(points)):
+    node.GetNthFiducialPosition(n, position)
+    points[n] = position
+  return points
+
+
+def getPoint(node, index):
+  """Return the RAS position of control point index as a float64 array."""
+  position = [0.0, 0.0, 0.0]
+  node.GetNthFiducialPosition(index, position)
+  return np.array(position)
+
+
+def setPoints(node, points, start=0, labels=None):
+  """Move control points start, start+1, ... of node to the (N,3) RAS points.
+
+  Points past the end of the list are added (labelled from labels if given).
+  Existing labels are changed only where labels has a different one. All
+  changes are made in one StartModify/EndModify block.
+  """
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  wasModifying = node.StartModify()
+  try:
+    for n, point in enumerate(points):
+      index = start + n
+      label = labels[n] if labels is not None else None
+      if index < node.GetNumberOfFiducials():
+        node.SetNthFiducialPosition(index, point[0], point[1], point[2])
+        if label is not None and node.GetNthFiducialLabel(index) != label:
+          node.SetNthFiducialLabel(index, label)
+      elif label is not None:
+        node.AddFiducial(point[0], point[1], point[2], label)
+      else:
+        node.AddFiducial(point[0], point[1], point[2])
+  finally:
+    node.EndModify(wasModifying)
@@ -0,0 +1,84 @@
+"""References to the scene nodes the planner works with.
+
+slicer.util.getNode scans the whole scene for every call, so looking nodes up
+by name or pattern on each slider tick gets slower as the scene grows during a
+procedure. NodeRegistry resolves each named node once, keeps a reference to
+it and forgets it when the node is removed or the scene is closed.
+"""
+import vtk, slicer
+
+
+def byName(name, className=None):
+  """Return a finder of the first node called name (and of class className)."""
+  def find():
+    if className is None:
+      return slicer.mrmlScene.GetFirstNodeByName(name)
+    nodes = slicer.mrmlScene.GetNodesByClassByName(className, name)
+    return nodes.GetItemAsObject(0) if nodes.GetNumberOfItems() else None
+  return find
+
+
+def byPattern(pattern):
+  """Return a finder of the first node whose name matches the wildcard pattern."""
+  def find():
+    nodes = slicer.util.getNodes(pattern)
+    return next(iter(nodes.values()), None)
+  return find
+
+
+def byID(nodeID):
+  def find():
+    return slicer.mrmlScene.GetNodeByID(nodeID)
+  return find
+
+
+class NodeRegistry(object):
+  """Nodes registered under a key, looked up (or created) once.
+
+  register(key, find, create) gives the finder of a node and, optionally, a
+  function creating it. get(key) returns the cached node, resolving it on
+  the first call and again only after it was removed from the scene.
+  """
+
+  def __init__(self):
+    self.finders = {}
+    self.creators = {}
+    self.nodes = {}
+    self.observerTags = [
+      slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved),
+      slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.onSceneClosed),
+      ]
+
+  def register(self, key, find, create=None):
+    self.finders[key] = find
+    self.creators[key] = create
+    self.nodes.pop(key, None)
+
+  def get(self, key, create=True):
+    """Return the node of key, creating it if it does not exist and create is True; None otherwise."""
+    node = self.nodes.get(key)
+    if node is None:
+      node = self.finders[key]()
+      if node is None and create and self.creators[key]:
+        node = self.creators[key]()
+      if node is not None:
+        self.nodes[key] = node
+    return node
+
+  def clear(self):
+    self.nodes = {}
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, node):
+    for key in [key for key, cached in self.nodes.items() if cached is node]:
+      del self.nodes[key]
+
+  def onSceneClosed(self, caller, event):
+    self.clear()
+
+  def close(self):
+    """Stop observing the scene."""
+    for tag in self.observerTags:
+      slicer.mrmlScene.RemoveObserver(tag)
+    self.observerTags = []
+    self.clear()
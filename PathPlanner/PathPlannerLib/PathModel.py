@@ -0,0 +1,63 @@
+"""Needle path model.
+
+The path used to be rebuilt by markupstomodel as a closed surface around the
+'path' fiducials on every slider or fine-tuning change. PathModel keeps one
+line source and tube filter feeding the 'pathModel' node; updating the path
+only moves the two endpoints of the line.
+"""
+import vtk, slicer
+
+
+class PathModel(object):
+  """Tube between the entry point and the target, shown by the 'pathModel' node."""
+
+  RADIUS = 1.0
+  SIDES = 12
+
+  def __init__(self, name='pathModel', displayName='displayPath'):
+    self.name = name
+    self.displayName = displayName
+    self.line = vtk.vtkLineSource()
+    self.line.SetResolution(1)
+    self.tube = vtk.vtkTubeFilter()
+    self.tube.SetInputConnection(self.line.GetOutputPort())
+    self.tube.SetRadius(self.RADIUS)
+    self.tube.SetNumberOfSides(self.SIDES)
+    self.tube.CappingOn()
+    self.node = None
+    self.displayNode = None
+
+  def getNode(self):
+    """Return the model node, picking up or creating it once and connecting it to the tube."""
+    if self.node is None or self.node.GetScene() is None:
+      self.node = slicer.mrmlScene.GetFirstNodeByName(self.name)
+      if self.node is None or not self.node.IsA('vtkMRMLModelNode'):
+        self.node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', self.name)
+      self.node.SetPolyDataConnection(self.tube.GetOutputPort())
+    return self.node
+
+  def getDisplayNode(self):
+    if self.displayNode is None or self.displayNode.GetScene() is None:
+      self.displayNode = slicer.mrmlScene.GetFirstNodeByName(self.displayName)
+      if self.displayNode is None or not self.displayNode.IsA('vtkMRMLModelDisplayNode'):
+        self.displayNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelDisplayNode', self.displayName)
+        self.displayNode.SetSliceIntersectionVisibility(True)
+        self.displayNode.SetSliceIntersectionThickness(3)
+      self.getNode().SetAndObserveDisplayNodeID(self.displayNode.GetID())
+    return self.displayNode
+
+  def update(self, entry, target):
+    """Move the path to the entry and target RAS points."""
+    node = self.getNode()
+    self.line.SetPoint1(float(entry[0]), float(entry[1]), float(entry[2]))
+    self.line.SetPoint2(float(target[0]), float(target[1]), float(target[2]))
+    # the node only watches the tube output: update it and tell the views the mesh changed
+    node.GetPolyData().Modified()
+
+  def setColor(self, r, g, b):
+    displayNode = self.getDisplayNode()
+    if displayNode.GetColor() != (r, g, b):
+      displayNode.SetColor(r, g, b)
+
+  def setVisibility(self, visible):
+    self.getDisplayNode().SetVisibility(visible)
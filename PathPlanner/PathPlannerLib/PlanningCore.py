@@ -0,0 +1,342 @@
+"""Slicer-independent geometry of the Smart Template path planner.
+
+Everything in this module works on plain NumPy arrays, so the planner can run
+from PathPlannerLogic, from scripts and from benchmarks without a Slicer scene.
+All positions are in millimeters. Template coordinates have their origin at the
+center of the Smart Template front face, with the z axis pointing to the
+insertion depth.
+"""
+import collections
+import numpy as np
+
+# dimentions from the center of the RCM to the edge of the needle guide:
+DIM1 = 54.5
+DIM2 = 49.5
+DIM3 = 44.5
+DIM4 = 39.5
+DIM5 = 34.5
+GUIDE_OFFSETS = np.array([DIM1, DIM2, DIM3, DIM4, DIM5])
+
+deg2rad = 3.14/180.0
+
+#translation limits of Smart Template
+LIMITS = [-25,25,-30,30]
+
+#angulation limit of the needle guide [rad]
+ANGLE_LIMIT = 0.35
+
+# Needle lengths available for the procedure [mm] and how far the tip of a
+# needle inserted up to its hub may pass the target [mm]. These defaults are
+# placeholders, not device or clinical specifications: the lengths have to
+# come from the needles stocked for the procedure and the tolerance from the
+# clinical team. The module reads both from its settings (Insertion lengths
+# panel), the batch planner from its --needle-lengths and --tolerance options.
+NEEDLE_LENGTHS = np.array([150.0, 200.0])
+DEPTH_TOLERANCE = 20.0
+
+# feasibility codes returned by checkKinematics
+FEASIBLE = 0
+ANGLE_LIMIT_REACHED = 1
+TRANSLATION_LIMIT_REACHED = 2
+DEPTH_LIMIT_REACHED = 3
+
+# tolerance on the angle limit for entries solved exactly on the limit
+_ANGLE_TOLERANCE = 1e-9
+
+
+def templateMatrix(zFrameMatrix):
+  """Return the 4x4 template-to-RAS matrix for a zFrame-to-RAS matrix."""
+  _rotation = np.identity(4)
+  _rotation[1,1] = 0.0
+  _rotation[1,2] = 1.0
+  _rotation[2,1] = -1.0
+  _rotation[2,2] = 0.0
+
+  _translation = np.identity(4)
+  _translation[1,3] = 107.0
+  _translation[2,3] = -114.0
+
+  return np.dot(_translation, np.dot(np.asarray(zFrameMatrix, dtype=float), _rotation))
+
+
+def transformPoints(matrix, points):
+  """Apply a 4x4 matrix to a (3,) point or an (N,3) array of points."""
+  points = np.asarray(points, dtype=float)[..., :3]
+  return np.dot(points, matrix[:3,:3].T) + matrix[:3,3]
+
+
+def isWithinLimits(entry):
+  """True where the entry point (template coordinates) is inside the translation limits."""
+  entry = np.asarray(entry)
+  return ((entry[...,0] >= LIMITS[0]) & (entry[...,0] <= LIMITS[1]) &
+          (entry[...,1] >= LIMITS[2]) & (entry[...,1] <= LIMITS[3]))
+
+
+def checkKinematics(entry, target, zdist):
+  """Return the feasibility codes (FEASIBLE, ANGLE_LIMIT_REACHED, ...) of entry/target pairs.
+
+  entry and target are (3,) or (N,3) arrays in template coordinates.
+  """
+  entry = np.asarray(entry)
+  target = np.asarray(target)
+  zdist = np.asarray(zdist)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    angles = np.arcsin((entry[...,:2]-target[...,:2])/zdist[...,None])
+  angleOk = np.all(np.abs(angles) <= ANGLE_LIMIT + _ANGLE_TOLERANCE, axis=-1)
+  return np.where(zdist <= 0, DEPTH_LIMIT_REACHED,
+                  np.where(~angleOk, ANGLE_LIMIT_REACHED,
+                           np.where(isWithinLimits(entry), FEASIBLE, TRANSLATION_LIMIT_REACHED)))
+
+
+def solveEntry(target_z, preferred=None):
+  """Return (entry, status) of the optimal feasible entry points for targets in template coordinates.
+
+  The translation limits and the angle limit act on each axis separately, so
+  the feasible entries of a target at depth d form the box
+  [max(LIMITS_min, t - d*sin(ANGLE_LIMIT)), min(LIMITS_max, t + d*sin(ANGLE_LIMIT))]
+  on the template face. Both the angulation and the insertion length grow
+  with |entry - target| on each axis, so the entry closest to the preferred
+  one inside that box (by default the straight entry above the target)
+  minimizes both. The solution is a clip, exact and without branches, so it
+  works the same for one (3,) target or an (N,3) array. When the box is empty
+  the entry is clamped to the translation limits and status tells why the
+  target can not be reached.
+  """
+  target_z = np.asarray(target_z, dtype=float)
+  zdist = target_z[...,2]
+  low = np.array([LIMITS[0], LIMITS[2]])
+  high = np.array([LIMITS[1], LIMITS[3]])
+  reach = np.where(zdist > 0, zdist, 0.0)[...,None]*np.sin(ANGLE_LIMIT)
+  lo = np.maximum(low, target_z[...,:2] - reach)
+  hi = np.minimum(high, target_z[...,:2] + reach)
+  if preferred is None:
+    preferred = target_z[...,:2]
+  entry = np.zeros(target_z.shape)
+  entry[...,:2] = np.where(lo <= hi, np.clip(preferred, lo, hi), np.clip(target_z[...,:2], low, high))
+  return entry, checkKinematics(entry, target_z, zdist)
+
+
+def entryThroughCenter(center, target, zdist):
+  """Return the entry point on the template face of the line from target through center."""
+  center = np.asarray(center)
+  target = np.asarray(target)
+  zdist = np.asarray(zdist)[...,None]
+  entry = np.empty(np.broadcast(center, target).shape)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    entry[...,:2] = target[...,:2]-(zdist*(center[...,:2]-target[...,:2]))/(center[...,2]-target[...,2])[...,None]
+  entry[...,2] = target[...,2]-zdist[...,0]
+  return entry
+
+
+def pathAngles(target, point):
+  """Return the coronal and sagittal angles [deg] of the line from point to target."""
+  target = np.asarray(target)
+  point = np.asarray(point)
+  return -np.arcsin((point[...,:2]-target[...,:2])/(point[...,2]-target[...,2])[...,None])*(180/3.14)
+
+
+def insertionLengths(depth, angleX=0.0, angleY=0.0):
+  """Return the insertion lengths for the five needle guide positions (DIM1-DIM5).
+
+  For an (N,) depth array the result is (N,5).
+  """
+  ins = np.asarray(depth)/np.cos(np.asarray(angleX)*deg2rad)/np.cos(np.asarray(angleY)*deg2rad)
+  return ins[...,None] + GUIDE_OFFSETS
+
+
+def selectGuidePosition(depth, angleX=0.0, angleY=0.0, needleLengths=NEEDLE_LENGTHS, tolerance=DEPTH_TOLERANCE):
+  """Return (candidate, position, needle) indices of the recommended guide position, or None.
+
+  depth, angleX and angleY [deg] describe one path or K candidate paths. A
+  needle inserted up to its hub through guide position i ends
+  needle length - insertion length i past the target, which must be between
+  0 and tolerance. All candidates, guide positions and needles are checked at
+  once; the valid combination with the smallest angulation wins, then the
+  one with the smallest overshoot.
+  """
+  depth, angleX, angleY = np.broadcast_arrays(np.atleast_1d(np.asarray(depth, dtype=float)),
+                                              np.atleast_1d(np.asarray(angleX, dtype=float)),
+                                              np.atleast_1d(np.asarray(angleY, dtype=float)))
+  overshoot = np.asarray(needleLengths, dtype=float) - insertionLengths(depth, angleX, angleY)[...,None]
+  valid = (overshoot >= 0) & (overshoot <= tolerance) & (depth > 0)[:,None,None]
+  index = np.flatnonzero(valid)
+  if len(index) == 0:
+    return None
+  angulation = np.broadcast_to(np.hypot(angleX, angleY)[:,None,None], valid.shape)
+  best = index[np.lexsort((overshoot.ravel()[index], angulation.ravel()[index]))[0]]
+  return tuple(int(i) for i in np.unravel_index(best, valid.shape))
+
+
+def angulatedPath(target, depth, angleX, angleY):
+  """Return the center and entry points of a path with the given angulation [deg].
+
+  The path is built from the target along -S, like the needle guide sliders do.
+  """
+  target = np.asarray(target, dtype=float)[:3]
+  entry = np.array([target[0] + depth*np.sin(angleX*deg2rad),
+                    target[1] + depth*np.sin(angleY*deg2rad),
+                    target[2] - depth])
+  center = target + (entry - target)/2.0
+  return center, entry
+
+
+def pointAtDepth(entry_z, target_z, depth):
+  """Return the points of the entry/target lines at the given template depth."""
+  entry_z = np.asarray(entry_z)
+  target_z = np.asarray(target_z)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    fraction = (target_z[...,2] - depth)/target_z[...,2]
+  return target_z + (entry_z - target_z)*fraction[...,None]
+
+
+def solveStraight(target_z):
+  """Return (center, entry, status) of the straight insertion plan for targets in template coordinates."""
+  target_z = np.asarray(target_z, dtype=float)
+  entry_z, check = solveEntry(target_z)
+  center_z = (entry_z + target_z)/2.0
+  return center_z, entry_z, check
+
+
+def entryAngles(entry_z, target_z):
+  """Return the (coronal, sagittal) needle guide angles [deg] of entry/target pairs in template coordinates."""
+  entry_z = np.asarray(entry_z)
+  target_z = np.asarray(target_z)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.arcsin(np.clip((entry_z[...,:2]-target_z[...,:2])/target_z[...,2][...,None], -1.0, 1.0))/deg2rad
+
+
+STATUS_NAMES = {
+  FEASIBLE: 'reachable',
+  ANGLE_LIMIT_REACHED: 'angle limit',
+  TRANSLATION_LIMIT_REACHED: 'translation limit',
+  DEPTH_LIMIT_REACHED: 'behind template',
+  }
+
+
+class PathPlan(object):
+  """Result of planning one target, or a batch of N targets.
+
+  Points are stored both in RAS (target, center, entry) and in template
+  coordinates (targetTemplate, centerTemplate, entryTemplate), as (3,) arrays
+  for one target or (N,3) arrays for a batch. depth is the target depth from
+  the template face, angles the (coronal, sagittal) needle guide angles in
+  degrees and status the checkKinematics codes.
+  """
+
+  def __init__(self, frame, target, targetTemplate, centerTemplate, entryTemplate, status):
+    self.frame = frame
+    self.target = np.asarray(target, dtype=float)[...,:3]
+    self.targetTemplate = targetTemplate
+    self.centerTemplate = centerTemplate
+    self.entryTemplate = entryTemplate
+    self.center = frame.toRAS(centerTemplate)
+    self.entry = frame.toRAS(entryTemplate)
+    self.depth = targetTemplate[...,2]
+    self.status = status
+    self.angles = entryAngles(entryTemplate, targetTemplate)
+
+  def __len__(self):
+    return len(self.target) if self.target.ndim == 2 else 1
+
+  def __getitem__(self, index):
+    """Return the plan of one target of a batch."""
+    return PathPlan(self.frame, self.target[index], self.targetTemplate[index], self.centerTemplate[index],
+                    self.entryTemplate[index], int(self.status[index]))
+
+  @property
+  def feasible(self):
+    return self.status == FEASIBLE
+
+  def insertionLengths(self):
+    return insertionLengths(self.depth, self.angles[...,0], self.angles[...,1])
+
+
+class TemplateFrame(object):
+  """Smart Template pose computed from a zFrame-to-RAS matrix.
+
+  Holds the forward (template to RAS) and inverse (RAS to template) matrices
+  and plans paths for RAS targets. Planning methods accept one (3,) target
+  or an (N,3) array of targets and work on the whole array at once.
+  """
+
+  def __init__(self, zFrameMatrix):
+    self.zFrameMatrix = np.array(zFrameMatrix, dtype=float)
+    self.matrix = templateMatrix(self.zFrameMatrix)
+    self.inverse = np.linalg.inv(self.matrix)
+
+  def toTemplate(self, points):
+    return transformPoints(self.inverse, points)
+
+  def toRAS(self, points):
+    return transformPoints(self.matrix, points)
+
+  def _plan(self, target, target_z, center_z, entry_z, check):
+    if np.ndim(check) == 0:
+      check = int(check)
+    return PathPlan(self, target, target_z, center_z, entry_z, check)
+
+  def planStraight(self, target):
+    """Plan a straight insertion, angulating only when the target is out of the translation limits."""
+    target_z = self.toTemplate(target)
+    center_z, entry_z, check = solveStraight(target_z)
+    return self._plan(target, target_z, center_z, entry_z, check)
+
+  def planThroughPoint(self, target, point):
+    """Plan an insertion that aims from the target through an anatomical point (e.g. a centroid)."""
+    target_z = self.toTemplate(target)
+    center_z = self.toTemplate(point)*np.ones_like(target_z)
+
+    preferred = entryThroughCenter(center_z, target_z, target_z[...,2])
+    entry_z, check = solveEntry(target_z, preferred[...,:2])
+    center_z = pointAtDepth(entry_z, target_z, center_z[...,2])
+    return self._plan(target, target_z, center_z, entry_z, check)
+
+  def angulatedPath(self, target, depth, angleX, angleY):
+    """Return (center, entry, inside) of the slider path of a RAS target (angulatedPath);
+    inside tells whether the entry is within the translation limits of the template."""
+    center, entry = angulatedPath(target, depth, angleX, angleY)
+    return center, entry, isWithinLimits(self.toTemplate(entry))
+
+  def planTargets(self, targets):
+    """Plan straight insertions for an (N,3) array of RAS targets in one pass."""
+    return self.planStraight(np.asarray(targets, dtype=float).reshape(-1, 3))
+
+
+class PlanCache(object):
+  """Bounded cache of plans with least-recently-used eviction.
+
+  Keys come from key(): the RAS target rounded to a micrometer, the version
+  of the zFrame it was planned with and any other planning inputs.
+  """
+
+  def __init__(self, maxSize=64):
+    self.maxSize = maxSize
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def key(target, zFrameVersion, *inputs):
+    return (tuple(np.round(np.asarray(target, dtype=float)[:3], 3)), zFrameVersion) + inputs
+
+  def get(self, key):
+    value = self.entries.get(key)
+    if value is None:
+      self.misses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.maxSize:
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries.clear()
+
+  def __len__(self):
+    return len(self.entries)
+
@@ -0,0 +1,120 @@
+"""Procedure log of the Smart Template clinical cases.
+
+The widget used to reopen one text file for every event and truncated it on
+every module reload. ProcedureLogger writes one JSON record per line from a
+background thread instead: log() only puts the event on a queue, so the GUI
+thread never waits for the disk. Every session gets its own file, named after
+the time it started, which is rotated when it grows over maxBytes.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+LOG_DIRECTORY = os.path.join(os.path.expanduser("~"), "Documents", "SmartTemplateLogs")
+
+
+def _toJSON(value):
+  # numpy arrays and scalars
+  if hasattr(value, 'tolist'):
+    return value.tolist()
+  return str(value)
+
+
+class ProcedureLogger(object):
+  """Buffered JSON-lines logger running on its own thread.
+
+  Records hold the time, the event type and the optional target, angles and
+  device state, plus any extra keyword fields. Lines are flushed to disk every
+  flushInterval seconds, and right away by flush() (e.g. on abort).
+  """
+
+  def __init__(self, directory=LOG_DIRECTORY, prefix="PathPlanner", maxBytes=10*1024*1024, flushInterval=1.0):
+    self.directory = directory
+    self.prefix = prefix
+    self.maxBytes = maxBytes
+    self.flushInterval = flushInterval
+    self.session = datetime.now().strftime("%Y%m%d-%H%M%S")
+    self.part = 0
+    self.file = None
+    self.path = None
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self.run, name="ProcedureLogger")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def log(self, event, target=None, angles=None, state=None, **fields):
+    """Queue an event record; returns immediately."""
+    record = {'time': time.time(), 'event': event}
+    if target is not None:
+      record['target'] = target
+    if angles is not None:
+      record['angles'] = angles
+    if state is not None:
+      record['state'] = state
+    record.update(fields)
+    self.queue.put(record)
+
+  def flush(self, timeout=None):
+    """Write everything queued so far to disk; waits up to timeout seconds (None: don't wait)."""
+    written = threading.Event()
+    self.queue.put(written)
+    if timeout is not None:
+      written.wait(timeout)
+
+  def close(self, timeout=2.0):
+    self.queue.put(None)
+    self.thread.join(timeout)
+
+  def run(self):
+    while True:
+      try:
+        item = self.queue.get(timeout=self.flushInterval)
+      except queue.Empty:
+        self.sync(False)
+        continue
+      if item is None:
+        self.sync(True)
+        if self.file:
+          self.file.close()
+          self.file = None
+        return
+      if isinstance(item, threading.Event):
+        self.sync(True)
+        item.set()
+        continue
+      self.write(item)
+
+  def write(self, record):
+    record['time'] = datetime.fromtimestamp(record['time']).isoformat()
+    line = json.dumps(record, default=_toJSON) + "\n"
+    try:
+      if self.file is None or self.file.tell() + len(line) > self.maxBytes:
+        self.rotate()
+      self.file.write(line)
+    except (IOError, OSError) as e:
+      logging.warning("Could not write the procedure log: %s" % e)
+      self.file = None
+
+  def rotate(self):
+    if self.file:
+      self.file.close()
+      self.part += 1
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    suffix = "" if self.part == 0 else "-%d" % self.part
+    self.path = os.path.join(self.directory, "%s-%s%s.jsonl" % (self.prefix, self.session, suffix))
+    self.file = open(self.path, 'a')
+
+  def sync(self, toDisk):
+    if self.file is None:
+      return
+    try:
+      self.file.flush()
+      if toDisk:
+        os.fsync(self.file.fileno())
+    except (IOError, OSError) as e:
+      logging.warning("Could not flush the procedure log: %s" % e)
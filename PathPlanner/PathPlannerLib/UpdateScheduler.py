@@ -0,0 +1,55 @@
+"""Coalescing of bursts of GUI events.
+
+Dragging a slider emits valueChanged for every step, and replanning on each
+of them queues up redundant work. UpdateScheduler throttles the callback: the
+first request starts the timer, later requests are merged into the pending
+run, and the callback runs one interval (one frame by default) after that
+first request. The timer is not restarted, so a long drag still updates every
+interval; the callback reads the slider values current when it runs.
+"""
+import qt
+
+
+class UpdateScheduler(object):
+  """Runs callback once, interval ms after the first of any number of schedule() calls.
+
+  requests counts the schedule() calls, runs the callback calls and merged
+  the requests folded into an already pending run.
+  """
+
+  # one frame at 60 Hz
+  INTERVAL = 16
+
+  def __init__(self, callback, interval=INTERVAL):
+    self.callback = callback
+    self.timer = qt.QTimer()
+    self.timer.setSingleShot(True)
+    self.timer.setInterval(interval)
+    self.timer.connect('timeout()', self.run)
+    self.requests = 0
+    self.merged = 0
+    self.runs = 0
+
+  def schedule(self):
+    self.requests += 1
+    if self.timer.isActive():
+      self.merged += 1
+    else:
+      self.timer.start()
+
+  def run(self):
+    self.timer.stop()
+    self.runs += 1
+    self.callback()
+
+  def flush(self):
+    """Run a pending update right away."""
+    if self.timer.isActive():
+      self.run()
+
+  def cancel(self):
+    """Drop a pending update."""
+    self.timer.stop()
+
+  def statistics(self):
+    return {'requests': self.requests, 'runs': self.runs, 'merged': self.merged}
@@ -0,0 +1,5 @@
+"""Helper modules of the PathPlanner scripted module.
+
+Modules in this package that do not import slicer, qt or vtk can be used
+outside of Slicer (scripts, benchmarks, offline studies).
+"""
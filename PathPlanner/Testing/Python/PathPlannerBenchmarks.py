@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Microbenchmarks of the planning hot paths.
+
+Times the PathPlannerLib functions the interactive planner calls on synthetic
+zFrame matrices and target clouds. The PlanningCore and AngleSearch
+benchmarks run offline with NumPy only; the MarkupsArrays ones need a Slicer
+scene and only run inside Slicer:
+
+  python PathPlannerBenchmarks.py                   # run and compare with the baselines
+  python PathPlannerBenchmarks.py --save-baseline   # run and store new baselines
+  python PathPlannerBenchmarks.py --filter plan     # only benchmarks with 'plan' in the name
+  Slicer --no-main-window --python-script PathPlannerBenchmarks.py   # include MarkupsArrays
+
+Each benchmark reports ops/sec and latency percentiles. Baselines are kept in
+benchmarkBaselines.json next to this file; a benchmark whose median latency
+is more than --tolerance times its baseline is reported as a regression and
+the script exits with status 1. Timings depend on the machine: the committed
+baselines come from a development machine, so save new ones with
+--save-baseline before comparing changes on another machine. Run the script
+before and after changes to PathPlannerLib; it is not registered as a ctest
+because timings on shared build machines are too noisy for a pass/fail gate.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from PathPlannerLib import AngleSearch, PlanningCore
+
+try:
+  import slicer
+  from PathPlannerLib import MarkupsArrays
+except ImportError:
+  slicer = None
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmarkBaselines.json')
+
+
+def randomZFrame(rng):
+  """Return a zFrame-to-RAS matrix with a small random rotation and offset, like a registration result."""
+  angles = rng.uniform(-0.1, 0.1, 3)
+  cx, cy, cz = np.cos(angles)
+  sx, sy, sz = np.sin(angles)
+  rotation = np.dot(np.dot([[1, 0, 0], [0, cx, -sx], [0, sx, cx]],
+                           [[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]),
+                    [[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+  matrix = np.identity(4)
+  matrix[:3,:3] = rotation
+  matrix[:3,3] = rng.uniform(-20, 20, 3)
+  return matrix
+
+
+def targetCloud(frame, rng, count):
+  """Return count RAS targets spread over the template workspace."""
+  targets_z = np.column_stack([rng.uniform(-40, 40, count), rng.uniform(-45, 45, count), rng.uniform(30, 150, count)])
+  return frame.toRAS(targets_z)
+
+
+def measure(function, repeat, minTime):
+  """Return the latencies [s] of repeat calls, repeating until at least minTime seconds were spent."""
+  function()
+  latencies = []
+  start = time.perf_counter()
+  while len(latencies) < repeat or time.perf_counter() - start < minTime:
+    t0 = time.perf_counter()
+    function()
+    latencies.append(time.perf_counter() - t0)
+  return np.array(latencies)
+
+
+def benchmarks(rng):
+  """Return {name: function} of the benchmarked operations."""
+  zFrame = randomZFrame(rng)
+  frame = PlanningCore.TemplateFrame(zFrame)
+  targets = targetCloud(frame, rng, 1000)
+  target = targets[0]
+  target_z = frame.toTemplate(target)
+  center = frame.toRAS([0.0, 0.0, 40.0])
+
+  functions = {
+    'transformZframe': lambda: PlanningCore.TemplateFrame(zFrame),
+    'pathStraight': lambda: frame.planStraight(target),
+    'pathThroughCenter': lambda: frame.planThroughPoint(target, center),
+    'checkKinematics': lambda: PlanningCore.checkKinematics(target_z*[1, 1, 0], target_z, target_z[2]),
+    'findNewCenter': lambda: PlanningCore.solveEntry(target_z),
+    'angulatedPath': lambda: frame.angulatedPath(target, target_z[2], 5.0, -3.0),
+    'insertionLengths': lambda: PlanningCore.insertionLengths(target_z[2], 5.0, -3.0),
+    'selectGuidePosition': lambda: PlanningCore.selectGuidePosition(target_z[2], 5.0, -3.0),
+    'planTargets1000': lambda: frame.planTargets(targets),
+    'angleSearch': lambda: AngleSearch.searchAngles(frame, target),
+    }
+
+  if slicer is not None and getattr(slicer, 'mrmlScene', None) is not None:
+    # the markups access of PathPlannerLogic.updatePoints and the target table
+    path = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'benchmarkPath')
+    MarkupsArrays.setPoints(path, np.zeros((3, 3)))
+    targetList = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'benchmarkTargets')
+    MarkupsArrays.setPoints(targetList, targets[:100])
+    center, entry, inside = frame.angulatedPath(target, target_z[2], 5.0, -3.0)
+    functions['markupsSetPath'] = lambda: MarkupsArrays.setPoints(path, [center, entry], start=1)
+    functions['markupsGetTargets100'] = lambda: MarkupsArrays.getPoints(targetList)
+  return functions
+
+
+def run(names, repeat, minTime):
+  rng = np.random.RandomState(0)
+  results = {}
+  for name, function in sorted(benchmarks(rng).items()):
+    if names and not any(pattern in name for pattern in names):
+      continue
+    latencies = measure(function, repeat, minTime)
+    results[name] = {
+      'opsPerSec': 1.0/latencies.mean(),
+      'p50': float(np.percentile(latencies, 50)),
+      'p95': float(np.percentile(latencies, 95)),
+      'p99': float(np.percentile(latencies, 99)),
+      'samples': len(latencies),
+      }
+  return results
+
+
+def report(results, baselines, tolerance):
+  """Print the results next to the baselines; return the names of the regressions."""
+  regressions = []
+  print('%-24s %12s %10s %10s %10s %10s' % ('benchmark', 'ops/sec', 'p50 [us]', 'p95 [us]', 'p99 [us]', 'vs base'))
+  for name, result in sorted(results.items()):
+    ratio = ''
+    baseline = baselines.get(name)
+    if baseline:
+      factor = result['p50']/baseline['p50']
+      ratio = '%.2fx' % factor
+      if factor > tolerance:
+        ratio += ' SLOWER'
+        regressions.append(name)
+    print('%-24s %12.0f %10.1f %10.1f %10.1f %10s' % (name, result['opsPerSec'],
+      result['p50']*1e6, result['p95']*1e6, result['p99']*1e6, ratio))
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="PathPlanner microbenchmarks")
+  parser.add_argument('--filter', action='append', default=[], help="run only benchmarks whose name contains this text")
+  parser.add_argument('--repeat', type=int, default=200, help="minimum number of timed calls")
+  parser.add_argument('--min-time', type=float, default=0.2, help="minimum seconds per benchmark")
+  parser.add_argument('--tolerance', type=float, default=1.5, help="median latency ratio reported as a regression")
+  parser.add_argument('--baseline', default=BASELINE_FILE)
+  parser.add_argument('--save-baseline', action='store_true')
+  args = parser.parse_args(argv)
+
+  results = run(args.filter, args.repeat, args.min_time)
+  baselines = {}
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baselines = json.load(f)
+  regressions = report(results, {} if args.save_baseline else baselines, args.tolerance)
+
+  if args.save_baseline:
+    baselines.update(results)
+    with open(args.baseline, 'w') as f:
+      json.dump(baselines, f, indent=2, sort_keys=True)
+    print('Baselines saved to %s' % args.baseline)
+    return 0
+  if regressions:
+    print('Regressions: %s' % ", ".join(regressions))
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""Local stand-in for the Smart Template ROS bridge.
+
+Runs an OpenIGTLink server on localhost that accepts the messages PathPlanner
+and Homing send (INIT*, MOVE, ABORT and SERIAL strings, targetTransformation
+and zFrameTransformation transforms) and answers with 'state', 'status',
+'statusTarget' and 'motorPosition' strings, like the device does. Rates and
+delays are configurable, so the modules can be exercised and command latency
+and status throughput measured without the robot:
+
+  python SmartTemplateServer.py serve --port 18944 --motor-rate 20
+  python SmartTemplateServer.py benchmark --port 18944 --commands 200
+
+Point the connector at 127.0.0.1 (ConnectionManager.connect(host='127.0.0.1'))
+to use it from Slicer. Only the Python standard library is needed.
+"""
+import argparse
+import math
+import socket
+import struct
+import sys
+import threading
+import time
+
+#
+# OpenIGTLink messages
+#
+
+HEADER = struct.Struct('>H12s20sQQQ')
+EXTENDED_HEADER = struct.Struct('>HHII')
+CRC64_POLY = 0x42F0E1EBA9EA3693
+CRC64_MASK = 0xFFFFFFFFFFFFFFFF
+US_ASCII = 3
+
+
+def _crc64Table():
+  table = []
+  for i in range(256):
+    crc = i << 56
+    for _ in range(8):
+      if crc & (1 << 63):
+        crc = ((crc << 1) ^ CRC64_POLY) & CRC64_MASK
+      else:
+        crc = (crc << 1) & CRC64_MASK
+    table.append(crc)
+  return table
+
+CRC64_TABLE = _crc64Table()
+
+
+def crc64(data):
+  crc = 0
+  for byte in bytearray(data):
+    crc = CRC64_TABLE[((crc >> 56) ^ byte) & 0xFF] ^ ((crc << 8) & CRC64_MASK)
+  return crc
+
+
+def timestamp():
+  now = time.time()
+  seconds = int(now)
+  return (seconds << 32) | int((now - seconds)*(1 << 32))
+
+
+def packMessage(messageType, deviceName, body):
+  header = HEADER.pack(1, messageType.encode('ascii'), deviceName.encode('ascii'), timestamp(), len(body), crc64(body))
+  return header + body
+
+
+def packString(deviceName, text):
+  data = text.encode('ascii')
+  return packMessage('STRING', deviceName, struct.pack('>HH', US_ASCII, len(data)) + data)
+
+
+def packTransform(deviceName, matrix):
+  """matrix is a 4x4 nested list; OpenIGTLink stores the 3x3 part column by column, then the translation."""
+  values = [matrix[row][column] for column in range(3) for row in range(3)] + [matrix[row][3] for row in range(3)]
+  return packMessage('TRANSFORM', deviceName, struct.pack('>12f', *values))
+
+
+def receiveExactly(sock, size):
+  data = b''
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if not chunk:
+      raise EOFError('connection closed')
+    data += chunk
+  return data
+
+
+def receiveMessage(sock):
+  """Return (type, device name, content) of the next message; version 2+ extended headers and metadata are stripped."""
+  version, messageType, deviceName, _, bodySize, _ = HEADER.unpack(receiveExactly(sock, HEADER.size))
+  body = receiveExactly(sock, bodySize)
+  if version >= 2 and bodySize >= EXTENDED_HEADER.size:
+    extendedHeaderSize, metaHeaderSize, metaSize, _ = EXTENDED_HEADER.unpack(body[:EXTENDED_HEADER.size])
+    body = body[extendedHeaderSize:bodySize - metaHeaderSize - metaSize]
+  return messageType.rstrip(b'\0').decode('ascii'), deviceName.rstrip(b'\0').decode('ascii'), body
+
+
+def unpackString(content):
+  _, length = struct.unpack('>HH', content[:4])
+  return content[4:4+length].decode('ascii', 'replace')
+
+
+def unpackTransform(content):
+  values = struct.unpack('>12f', content[:48])
+  matrix = [[0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 1.0]]
+  for column in range(3):
+    for row in range(3):
+      matrix[row][column] = values[3*column + row]
+  for row in range(3):
+    matrix[row][3] = values[9 + row]
+  return matrix
+
+#
+# Device stand-in
+#
+
+class SmartTemplateServer(object):
+  """Serves one OpenIGTLink client at a time and simulates the device answers.
+
+  statusRate and motorRate are the rates [Hz] of the periodic 'status' and
+  'motorPosition' streams, replyDelay the processing delay [s] before a
+  command is answered and moveDuration the time a MOVE takes to finish.
+  """
+
+  def __init__(self, host='127.0.0.1', port=18944, statusRate=1.0, motorRate=10.0, replyDelay=0.0, moveDuration=2.0):
+    self.host = host
+    self.port = port
+    self.statusRate = statusRate
+    self.motorRate = motorRate
+    self.replyDelay = replyDelay
+    self.moveDuration = moveDuration
+    self.sendLock = threading.Lock()
+    self.client = None
+    self.running = False
+    self.footSwitch = "FTSW OFF"
+    self.motors = [0.0, 0.0, 0.0, 0.0]
+    self.goal = [0.0, 0.0, 0.0, 0.0]
+    self.moveStart = None
+    self.target = None
+    self.zFrame = None
+    self.received = {}
+    self.sent = 0
+
+  def serve(self):
+    self.running = True
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((self.host, self.port))
+    server.listen(1)
+    server.settimeout(0.5)
+    print('Smart Template stand-in listening on %s:%d' % (self.host, self.port))
+    streams = threading.Thread(target=self.streamStatus)
+    streams.daemon = True
+    streams.start()
+    try:
+      while self.running:
+        try:
+          client, address = server.accept()
+        except socket.timeout:
+          continue
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print('Client connected from %s:%d' % address)
+        self.client = client
+        self.send('state', "No")
+        self.send('status', self.footSwitch)
+        try:
+          self.handleClient(client)
+        except (EOFError, socket.error):
+          pass
+        print('Client disconnected')
+        self.client = None
+        client.close()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      self.running = False
+      server.close()
+      print('Received %s, sent %d messages' % (self.received, self.sent))
+
+  def send(self, deviceName, text):
+    client = self.client
+    if client is None:
+      return
+    with self.sendLock:
+      try:
+        client.sendall(packString(deviceName, text))
+        self.sent += 1
+      except socket.error:
+        pass
+
+  def handleClient(self, client):
+    while self.running:
+      messageType, deviceName, content = receiveMessage(client)
+      self.received[deviceName] = self.received.get(deviceName, 0) + 1
+      if self.replyDelay:
+        time.sleep(self.replyDelay)
+      if messageType == 'STRING':
+        self.onCommand(unpackString(content))
+      elif messageType == 'TRANSFORM' and deviceName == 'targetTransformation':
+        self.onTarget(unpackTransform(content))
+      elif messageType == 'TRANSFORM' and deviceName == 'zFrameTransformation':
+        self.zFrame = unpackTransform(content)
+        self.send('status', "zFrame received")
+
+  def onCommand(self, command):
+    if command.startswith('INIT'):
+      self.goal = [0.0, 0.0, 0.0, 0.0]
+      self.startMove()
+    elif command == 'MOVE':
+      if self.target is None:
+        self.send('state', "No")
+      else:
+        self.startMove()
+    elif command == 'ABORT':
+      self.moveStart = None
+      self.send('state', "Movement aborted")
+    elif command == 'SERIAL':
+      self.footSwitch = "FTSW OFF"
+      self.send('status', self.footSwitch)
+
+  def onTarget(self, matrix):
+    self.target = [matrix[0][3], matrix[1][3], matrix[2][3]]
+    angleX = math.degrees(math.atan2(matrix[2][1], matrix[2][2]))
+    angleY = math.degrees(math.asin(max(-1.0, min(1.0, -matrix[2][0]))))
+    self.goal = [self.target[0], self.target[1], angleX, angleY]
+    self.send('statusTarget', "%.1f, %.1f, %.1f - %.1f, %.1f" % (self.target[0], self.target[1], self.target[2], angleX, angleY))
+    self.send('state', "Waiting movement")
+
+  def startMove(self):
+    self.moveStart = (time.time(), list(self.motors))
+    self.footSwitch = "FTSW ON"
+    self.send('status', self.footSwitch)
+
+  def updateMotors(self):
+    if self.moveStart is None:
+      return
+    startTime, startPosition = self.moveStart
+    fraction = min(1.0, (time.time() - startTime)/self.moveDuration) if self.moveDuration > 0 else 1.0
+    self.motors = [start + (goal - start)*fraction for start, goal in zip(startPosition, self.goal)]
+    if fraction >= 1.0:
+      self.moveStart = None
+      self.footSwitch = "FTSW OFF"
+      self.send('state', "Movement done")
+      self.send('status', self.footSwitch)
+
+  def streamStatus(self):
+    nextStatus = nextMotor = time.time()
+    while self.running:
+      now = time.time()
+      if self.motorRate > 0 and now >= nextMotor:
+        self.updateMotors()
+        self.send('motorPosition', ", ".join('%.2f' % value for value in self.motors))
+        nextMotor += 1.0/self.motorRate
+      if self.statusRate > 0 and now >= nextStatus:
+        self.send('status', self.footSwitch)
+        nextStatus += 1.0/self.statusRate
+      pending = [t for t, rate in ((nextMotor, self.motorRate), (nextStatus, self.statusRate)) if rate > 0]
+      time.sleep(max(0.0, min(pending + [now + 0.1]) - time.time()))
+
+#
+# Benchmark client
+#
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values)-1, int(fraction*len(values)))]
+
+
+def benchmark(host, port, commands, duration):
+  """Measure ABORT round trips ('state' answer) and the status throughput of a running server."""
+  sock = socket.create_connection((host, port))
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  counts = {}
+  replies = []
+  replied = threading.Event()
+
+  def read():
+    try:
+      while True:
+        messageType, deviceName, content = receiveMessage(sock)
+        counts[deviceName] = counts.get(deviceName, 0) + 1
+        if deviceName == 'state' and unpackString(content) == "Movement aborted":
+          replies.append(time.perf_counter())
+          replied.set()
+    except (EOFError, socket.error):
+      pass
+
+  reader = threading.Thread(target=read)
+  reader.daemon = True
+  reader.start()
+
+  latencies = []
+  for _ in range(commands):
+    replied.clear()
+    start = time.perf_counter()
+    sock.sendall(packString('ABORT', "ABORT"))
+    if replied.wait(5.0):
+      latencies.append(replies[-1] - start)
+
+  counts.clear()
+  time.sleep(duration)
+  throughput = dict((name, count/duration) for name, count in counts.items())
+  sock.close()
+
+  if latencies:
+    print('round trip over %d commands: p50 %.3f ms, p95 %.3f ms, max %.3f ms' % (
+      len(latencies), percentile(latencies, 0.50)*1000, percentile(latencies, 0.95)*1000, max(latencies)*1000))
+  print('status throughput [messages/s]: ' + ", ".join('%s %.1f' % item for item in sorted(throughput.items())))
+  return latencies, throughput
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Smart Template OpenIGTLink stand-in")
+  parser.add_argument('mode', choices=['serve', 'benchmark'])
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=18944)
+  parser.add_argument('--status-rate', type=float, default=1.0, help="'status' messages per second")
+  parser.add_argument('--motor-rate', type=float, default=10.0, help="'motorPosition' messages per second")
+  parser.add_argument('--reply-delay', type=float, default=0.0, help="seconds before a command is answered")
+  parser.add_argument('--move-duration', type=float, default=2.0, help="seconds a MOVE takes")
+  parser.add_argument('--commands', type=int, default=100, help="round trips measured by the benchmark")
+  parser.add_argument('--duration', type=float, default=2.0, help="seconds of status throughput measured by the benchmark")
+  args = parser.parse_args(argv)
+
+  if args.mode == 'serve':
+    SmartTemplateServer(args.host, args.port, args.status_rate, args.motor_rate, args.reply_delay, args.move_duration).serve()
+  else:
+    benchmark(args.host, args.port, args.commands, args.duration)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())